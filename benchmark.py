@@ -0,0 +1,180 @@
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import subprocess
+import tempfile
+import contextlib
+import io
+
+import pacetools
+
+
+#benchmark of PACEXML on synthetic buildings built on top of audit_vierge.xml
+#
+#    python benchmark.py --facades 8 --wall-types 6 --openings 40 --layers 3 --repeat 3 --output results.json
+#
+#the whole audits (open, build, write) are timed; the methods are timed in one more audit, profiled
+#(PACEXML(...,profile=True), see PACEXML.stats), which is not part of the timings as profiling slows it down
+#the results are written as json so that they can be compared between versions
+
+
+directions = ['N','NE','E','SE','S','SW','W','NW']
+
+layerSpecs = [{'Category':'Isolants',
+               'Material':'Laine minérale (MW)',
+               'Description':'Laine minérale continue',
+               'lambda':0.035,
+               'thickness':0.12,
+               'R':'',
+               'woodfraction':''},
+              {'Category':'Blocs creux (intérieurs)',
+               'Material':'Blocs creux de béton (19 cm)',
+               'Description':'Bloc 19',
+               'lambda':'',
+               'thickness':0.19,
+               'R':'',
+               'woodfraction':''},
+              {'Category':'Isolants',
+               'Material':'Laine minérale (MW)',
+               'Description':'Laine minérale fb=0.1',
+               'lambda':0.035,
+               'thickness':0.1,
+               'R':'',
+               'woodfraction':0.1}]
+
+
+def buildSyntheticAudit(xml,facades=4,wallTypes=4,openings=10,layers=2):
+    #N facades with one wall instance per wall type (at most 4), M wall types with L layers each,
+    #K openings spread over the walls, plus a roof plane and two floors
+
+    xml.setMeasurementMethod('surfacesbrutes')
+
+    for i in range(wallTypes):
+        xml.addConstructionElement('wall','M%d' % i,'mur %d' % i,'OPEN_AIR','FULL')
+    for i in range(3):
+        xml.addConstructionElement('roof','T%d' % i,'toit %d' % i,'OPEN_AIR','INCLINED')
+    for i in range(2):
+        xml.addConstructionElement('floor','P%d' % i,'plancher %d' % i,'GROUND','')
+    for i in range(3):
+        xml.addConstructionElement('transparentElement','F%d' % i,'fenetre %d' % i,'OPEN_AIR','')
+
+    for i in range(wallTypes):
+        xml.setWallDetails('M%d' % i,0.30,'Pierre < 40',[layerSpecs[k % len(layerSpecs)] for k in range(layers)])
+
+    for f in range(facades):
+        facadeID = xml.addFacade(directions[f % len(directions)],100)
+        for i in range(min(wallTypes,4)):
+            xml.addWallInstance(facadeID,'M%d' % ((f+i) % wallTypes),20+i)
+
+    roofPlaneID = xml.addRoofPlane('S',35,100)
+    for i in range(3):
+        xml.addRoofInstance(roofPlaneID,'T%d' % i,30)
+
+    xml.addFloorInstance('P0',60)
+    xml.addFloorInstance('P1',40)
+
+    for k in range(openings):
+        xml.addOpeningGrossMethod('O%d' % k,'M%d' % (k % wallTypes),'F%d' % (k % 3),directions[k % len(directions)])
+
+    xml.setHeatedVolume(100*facades,120*facades)
+    xml.addFloorLevel('Rez de chaussee',40*facades,'init')
+    xml.setInertia('MODERATE_HEAVY')
+    xml.setWeatherStations()
+    xml.setInsideTemperature(18)
+
+
+def runAudit(args,outputFile,profile=False):
+    #one whole audit, returns the durations of its steps and xml.stats()
+
+    durations = {}
+
+    start = time.perf_counter()
+    xml = pacetools.PACEXML(args.template,deferFinalize=args.defer,lazy=args.lazy,profile=profile)
+    xml.setTemplatesDir(args.templates_dir)
+    durations['open'] = time.perf_counter()-start
+
+    start = time.perf_counter()
+    buildSyntheticAudit(xml,args.facades,args.wall_types,args.openings,args.layers)
+    durations['build'] = time.perf_counter()-start
+
+    start = time.perf_counter()
+    xml.writePaceFile(outputFile)
+    durations['write'] = time.perf_counter()-start
+
+    durations['total'] = durations['open']+durations['build']+durations['write']
+
+    return durations,xml.stats()
+
+
+def gitVersion():
+
+    try:
+        directory = os.path.dirname(os.path.abspath(pacetools.__file__))
+        return subprocess.check_output(['git','describe','--always','--dirty'],cwd=directory,stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='benchmark of PACEXML on a synthetic building')
+    parser.add_argument('--template',default=os.path.join('paceTemplates','audit_vierge.xml'))
+    parser.add_argument('--templates-dir',default='paceTemplates')
+    parser.add_argument('--facades',type=int,default=4)
+    parser.add_argument('--wall-types',type=int,default=4)
+    parser.add_argument('--openings',type=int,default=10)
+    parser.add_argument('--layers',type=int,default=2)
+    parser.add_argument('--repeat',type=int,default=3,help='number of timed audits (plus one profiled audit, not timed)')
+    parser.add_argument('--defer',action='store_true',help='PACEXML(...,deferFinalize=True)')
+    parser.add_argument('--lazy',action='store_true',help='PACEXML(...,lazy=True)')
+    parser.add_argument('--label',default=None,help='free text stored with the results, e.g. a version name')
+    parser.add_argument('--output',default=None,help='json file (default: printed)')
+    args = parser.parse_args(argv)
+
+    audits = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        #PACEXML prints progress and warnings, they would be mixed with the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = runAudit(args,os.path.join(directory,'profiled.pae'),profile=True)[1]
+            for k in range(args.repeat):
+                durations = runAudit(args,os.path.join(directory,'benchmark%d.pae' % k))[0]
+                audits.append(durations)
+
+    methods = {name:dict(m,mean=m['time']/m['calls']) for name,m in stats.pop('methods',{}).items()}
+
+    results = {'label':args.label,
+               'version':gitVersion(),
+               'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python':platform.python_version(),
+               'platform':platform.platform(),
+               'parameters':{'template':args.template,
+                             'facades':args.facades,
+                             'wallTypes':args.wall_types,
+                             'openings':args.openings,
+                             'layers':args.layers,
+                             'defer':args.defer,
+                             'lazy':args.lazy},
+               'audits':audits,
+               'best':{step:min(a[step] for a in audits) for step in audits[0]} if len(audits) > 0 else {},
+               'counters':stats,
+               'methods':methods}
+
+    text = json.dumps(results,indent=2)
+
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output,'w') as f:
+            f.write(text)
+
+        print('total %.2f s (best of %d), slowest methods:' % (results['best']['total'],args.repeat))
+        for name,m in sorted(methods.items(),key=lambda x:-x[1]['time'])[:10]:
+            print('  %-32s %5d calls %8.3f s' % (name,m['calls'],m['time']))
+
+
+if __name__ == "__main__":
+    main()
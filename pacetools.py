@@ -1,15 +1,86 @@
 import xml.etree.ElementTree as ET
 import os
-import numpy as np
+import contextlib
+import collections
+import io
+import re
+import time
+import copy
+import importlib
+
+
+class lazyModule:
+
+    #module imported on first use of one of its attributes
+    #numpy takes about 0.1 s to import, and most audits never use it (materials, read and thermal functions)
+
+    def __init__(self,name):
+
+        self.name = name
+        self.module = None
+
+
+    def __getattr__(self,attr):
+
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+
+        return getattr(self.module,attr)
+
+
+np = lazyModule('numpy')
+
 
 
 class PACEXML:
 
-    def __init__(self,templateFile):
+    #sections of the audit that PACEXML never edits (parent tag, tag)
+    #with lazy=True they are not parsed, their bytes are copied from the template file when writing
+    #empty element standing for a picture until the file is written (see setImageFile)
+    imageTag = 'pacetoolsImage'
+
+    lazySections = [('building','hotWater'),
+                    ('building','heating'),
+                    ('building','auxiliary'),
+                    ('building','cooling'),
+                    ('building','overHeating'),
+                    ('building','ventilation'),
+                    ('building','nonEnergeticAspects'),
+                    ('building','cogeneration'),
+                    ('building','photovoltaic'),
+                    ('building','solarThermal'),
+                    ('building','monthlyBuildingResults'),
+                    ('skin','monthlyHeatResults')]
+
+    def __init__(self,templateFile,deferFinalize=False,lazy=False,cached=False,profile=False):
        
+        #deferFinalize: the tree is reordered only once, in writePaceFile, instead of after every new instance
+        #(see also batch()); in both modes, new elements get ids above the highest one and the tree is renumbered
+        #in document order by writePaceFile
+        self.deferFinalize = deferFinalize
+        self.batchDepth = 0
+        self.reorderPending = False
+        self.renumberPending = True #False when the ids are known to be 1...N in document order
+
+        #lazy: the lazySections are kept as raw byte ranges of the template file (see parseLazy)
+        self.rawSegments = []
+
+        #pictures, embedded when writing (see setImageFile)
+        self.imageFiles = []
+
+        #profile: see enableProfiling and stats
+        self.counters = collections.Counter()
+        self.methodsTimes = None
+
         try:
         
-            self.mainTree = ET.parse(templateFile)
+            if cached:
+                #copy of the template parsed once per process (see fromCachedTemplate)
+                self.mainTree = ET.ElementTree(templatesCache.getElement(templateFile))
+            elif lazy:
+                self.mainTree = self.parseLazy(templateFile)
+            else:
+                self.mainTree = ET.parse(templateFile)
 
 
             self.constructionElementsClasses = {'wall':'com.hemmis.mrw.pace.model.skin.Wall',
@@ -17,6 +88,8 @@ class PACEXML:
                                                 'floor':'com.hemmis.mrw.pace.model.skin.Floor',
                                                 'transparentElement':'com.hemmis.mrw.pace.model.skin.TransparentElement'}
 
+            self.constructionElementsTypes = {v:k for k,v in self.constructionElementsClasses.items()}
+
 
             self.wallOpaqueCompositions={'Pierre < 40':3,
                                          'Pierre > 40':4,
@@ -27,6 +100,16 @@ class PACEXML:
                                          'Ossature bois':12,
                                          'Cloison légère intérieure':13
                                          }
+
+            self.buildIndex()
+
+            if not self.checkRawSegments():
+                self.rawSegments = []
+                self.mainTree = ET.parse(templateFile)
+                self.buildIndex()
+
+            if profile:
+                self.enableProfiling()
             
             
             
@@ -35,15 +118,443 @@ class PACEXML:
             print("could not read PAE file")            
 
       
+    @classmethod
+    def fromCachedTemplate(cls,templateFile,deferFinalize=False):
+        #new audit from a base template that is parsed only once per process (it stays in templatesCache)
+        #each audit gets its own copy of the tree, about twice as fast as parsing audit_vierge.xml again
+        #
+        #    for job in jobs:
+        #        xml = PACEXML.fromCachedTemplate('paceTemplates/audit_vierge.xml')
+
+        return cls(templateFile,deferFinalize,cached=True)
+
+
+    def enableProfiling(self):
+        #from now on, every method of this instance records its number of calls and cumulative wall time
+        #(inclusive: the time of the methods it calls is counted too) and the searches on the main tree are counted
+        #the counters of allocateIDsBlock, finalize and reorderIdsAndReferences are always kept, see stats()
+
+        if self.methodsTimes is not None:
+            return
+
+        self.methodsTimes = {}
+
+        def timed(name,method):
+
+            def wrapper(*args,**kwargs):
+                start = time.perf_counter()
+                try:
+                    return method(*args,**kwargs)
+                finally:
+                    calls,total = self.methodsTimes.get(name,(0,0.))
+                    self.methodsTimes[name] = (calls+1,total+time.perf_counter()-start)
+
+            return wrapper
+
+        for name in dir(type(self)):
+            if not name.startswith('_') and name not in ('enableProfiling','stats','fromCachedTemplate') and callable(getattr(type(self),name)):
+                setattr(self,name,timed(name,getattr(self,name)))
+
+        self.mainTree = profiledElementTree(self.mainTree,self.counters)
+
+
+    def stats(self):
+        #counters of this instance:
+        #  treeScans: searches started from the root of the main tree (find, findall, iter...), including the
+        #             full walks of buildIndex, finalize and reorderIdsAndReferences (counted with profiling only)
+        #  allocatedIDs: ids given to new elements by allocateIDsBlock
+        #  renumberings: renumberings of the whole tree by finalize
+        #  reorders, reorderInversions, reorderMaxDepth: passes of reorderIdsAndReferences, references swapped with
+        #             their definition, deepest element reached by the walk (it is not recursive, see reorderIdsAndReferences)
+        #  methods: {method name: {'calls', 'time'}} with profiling only
+
+        stats = {k:self.counters[k] for k in ['treeScans','allocatedIDs','renumberings','reorders','reorderInversions','reorderMaxDepth','indexBuilds']}
+
+        if self.methodsTimes is not None:
+            stats['methods'] = {name:{'calls':calls,'time':total} for name,(calls,total) in sorted(self.methodsTimes.items())}
+
+        return stats
+
+
+    def dumpStats(self,filename):
+
+        import json
+
+        with open(filename,'w') as f:
+            json.dump(self.stats(),f,indent=2)
+
+
+    def buildIndex(self):
+        #live index of the main tree: id --> element, id --> referencing elements, element --> parent,
+        #(elementType, label) --> construction elements
+        #built once here, then kept up to date by every mutator (appendElement, removeElement, allocateIDsBlock...)
+        #call it again if the tree was modified from outside of PACEXML
+
+        self.idIndex = {}
+        self.referencesIndex = {}
+        self.parentMap = {}
+        self.labelIndex = {}
+        self.highestID = 0
+
+        self.counters['indexBuilds'] += 1
+        if self.methodsTimes is not None:
+            self.counters['treeScans'] += 1
+
+        self.registerSubtree(self.mainTree.getroot(),None)
+
+
+    def registerSubtree(self,element,parent):
+
+        if parent is not None:
+            self.parentMap[element] = parent
+
+        for e in element.iter():
+
+            for child in e:
+                self.parentMap[child] = e
+
+            if 'id' in e.attrib:
+                self.renumberPending = True
+                elemID = e.attrib['id']
+                self.idIndex.setdefault(elemID,e)
+                if elemID.isdigit():
+                    self.highestID = max(self.highestID,int(elemID))
+
+                #construction element definition (its tag may have been swapped, in which case the class is in an attribute)
+                elementType = self.constructionElementsTypes.get(e.tag,self.constructionElementsTypes.get(e.attrib.get('class')))
+                if elementType is not None:
+                    elementsWithLabel = self.labelIndex.setdefault((elementType,e.findtext('reference')),[])
+                    if e not in elementsWithLabel:
+                        elementsWithLabel.append(e)
+
+            if 'reference' in e.attrib:
+                self.referencesIndex.setdefault(e.attrib['reference'],[]).append(e)
+
+            if e.tag == rawSegment.tag:
+                segment = self.rawSegments[int(e.attrib['n'])]
+                self.highestID = max(self.highestID,int(e.attrib['id'])+segment.count-1)
+                for proxy in segment.proxies.values():
+                    self.referencesIndex.setdefault(proxy.attrib['reference'],[]).append(proxy)
+
+
+    def unregisterSubtree(self,element):
+
+        self.renumberPending = True
+
+        self.parentMap.pop(element,None)
+
+        for e in element.iter():
+
+            for child in e:
+                self.parentMap.pop(child,None)
+
+            if 'id' in e.attrib:
+
+                if self.idIndex.get(e.attrib['id']) is e:
+                    del self.idIndex[e.attrib['id']]
+
+                elementType = self.constructionElementsTypes.get(e.tag,self.constructionElementsTypes.get(e.attrib.get('class')))
+                if elementType is not None:
+                    elementsWithLabel = self.labelIndex.get((elementType,e.findtext('reference')),[])
+                    if e in elementsWithLabel:
+                        elementsWithLabel.remove(e)
+
+            if 'reference' in e.attrib:
+                refs = self.referencesIndex.get(e.attrib['reference'],[])
+                if e in refs:
+                    refs.remove(e)
+
+            if e.tag == rawSegment.tag:
+                for proxy in self.rawSegments[int(e.attrib['n'])].proxies.values():
+                    refs = self.referencesIndex.get(proxy.attrib['reference'],[])
+                    if proxy in refs:
+                        refs.remove(proxy)
+
+
+    def appendElement(self,parent,element):
+        #append an element (and its subtree) to an element of the main tree, keeping the index up to date
+
+        parent.append(element)
+        self.registerSubtree(element,parent)
+
+        return element
+
+
+    def addSubElement(self,parent,tag,attrib={}):
+
+        element = ET.SubElement(parent,tag,attrib)
+        self.registerSubtree(element,parent)
+
+        return element
+
+
+    def removeElement(self,parent,element):
+
+        parent.remove(element)
+        self.unregisterSubtree(element)
+
+
+    def getElementByID(self,elemID):
+
+        return self.idIndex.get(str(elemID))
+
+
+    def getNewID(self):
+        #fresh id, higher than any id of the main tree
+
+        self.highestID += 1
+
+        return str(self.highestID)
+
+
+    def isDeferred(self):
+
+        return self.deferFinalize or self.batchDepth > 0
+
+
+    @contextlib.contextmanager
+    def batch(self):
+        #everything added inside the with block is renumbered and reordered once, when leaving the block
+        #
+        #    with xml.batch():
+        #        xml.addWallInstance(...)
+        #        xml.addOpeningGrossMethod(...)
+
+        self.batchDepth += 1
+        try:
+            yield self
+        finally:
+            self.batchDepth -= 1
+
+        if not self.isDeferred():
+            self.finalize()
+
+
+    def finalize(self):
+        #single reorder and renumbering pass over the whole tree
+        #skipped if nothing has changed the ids since the last one (e.g. second call to writePaceFile)
+
+        if self.reorderPending:
+            self.reorderPending = False
+            self.reorderIdsAndReferences()
+
+        if self.renumberPending:
+            self.counters['renumberings'] += 1
+            self.renumberTreeOrElem(self.mainTree,1)
+            self.buildIndex()
+            self.renumberPending = False
+
+
+    def copy(self):
+        #independent copy of the audit, without parsing the template again: the parsed part of the tree is cloned,
+        #the raw segments of lazy=True stay byte ranges of the template file, parsed only in the copies that edit them
+        #(with lazy=True, the parsed part is about 5% of audit_vierge.xml)
+
+        other = copy.copy(self)
+
+        #wrappers of enableProfiling, bound to this instance
+        other.__dict__ = {name:value for name,value in self.__dict__.items() if not (name in dir(type(self)) and callable(value))}
+
+        tree = self.mainTree.tree if self.methodsTimes is not None else self.mainTree
+        other.mainTree = ET.ElementTree(cloneElement(tree.getroot()))
+
+        other.rawSegments = []
+        for segment in self.rawSegments:
+            segment = copy.copy(segment)
+            segment.placeholder = None
+            segment.proxies = {ref:ET.Element('reference',{'reference':proxy.attrib['reference']}) for ref,proxy in segment.proxies.items()}
+            other.rawSegments.append(segment)
+        for placeholder in other.mainTree.getroot().iter(rawSegment.tag):
+            other.rawSegments[int(placeholder.attrib['n'])].placeholder = placeholder
+
+        other.imageFiles = list(self.imageFiles)
+        other.batchDepth = 0
+        other.counters = collections.Counter()
+        other.methodsTimes = None
+
+        other.buildIndex()
+        other.renumberPending = self.renumberPending
+
+        if self.methodsTimes is not None:
+            other.enableProfiling()
+
+        return other
+
+
+    def variants(self,paramGrid,outputPattern,workers=1):
+        #writes one PAE file per combination of the parameters, each one built on a copy of this audit (see copy),
+        #which is the part common to all of them:
+        #
+        #    base = PACEXML('paceTemplates/audit_vierge.xml',lazy=True)
+        #    ...common part...
+        #    base.variants({'setHeatedVolume':[(1000,1200),(900,1100)],
+        #                   'setInsideTemperature':[18,20]},'variants/audit{index}.pae',workers=4)
+        #
+        #paramGrid: {PACEXML method: values}, a value is the arguments of one call (tuple --> *args, dict --> **kwargs,
+        #else the single argument), or a list of such dicts for explicit variants
+        #outputPattern: formatted with index and the method names (e.g. '{setInsideTemperature}')
+        #workers: number of processes (None --> one per cpu), the base is sent once to each of them (not profiled ones)
+        #returns [(output file, parameters, duration in s, error message or None)], in the order of the variants
+
+        import itertools
+
+        if isinstance(paramGrid,dict):
+            names = list(paramGrid.keys())
+            paramsList = [dict(zip(names,values)) for values in itertools.product(*[paramGrid[name] for name in names])]
+        else:
+            paramsList = list(paramGrid)
+
+        tasks = []
+        for k,params in enumerate(paramsList):
+            fields = {name:('-'.join(str(v) for v in value) if isinstance(value,(tuple,list)) else value) for name,value in params.items()}
+            tasks.append((k,params,outputPattern.format(index=k,**fields)))
+
+        #common reorder and renumbering, done once
+        self.finalize()
+
+        if workers == 1:
+            initVariantWorker(self)
+            results = [runVariant(task) for task in tasks]
+        else:
+            import multiprocessing
+            with multiprocessing.Pool(workers,initializer=initVariantWorker,initargs=(self,)) as pool:
+                results = pool.map(runVariant,tasks)
+
+        return [(output,paramsList[k],duration,error) for k,output,duration,error in results]
+
+
+    def validate(self):
+        #checks the main tree as PACE reads it (in document order), in one pass: see validateTree
+        #call it after finalize() (or writePaceFile) to check what is written, before that the references of the
+        #elements added since the last reorder may still come before their definitions
+
+        return validateTree(self.mainTree.getroot(),self.rawSegments)
+
+
+    def parseLazy(self,templateFile):
+        #parses the template without its lazySections, each of them is replaced by a rawSegment placeholder
+        #the sections are located by a byte search: the point is to not tokenize them at all, and iterparse
+        #does not give byte offsets
+        #a section is parsed as usual if its ids are not consecutive
+
+        if not isinstance(templateFile,(str,os.PathLike)):
+            return ET.parse(templateFile)
+
+        path = os.path.abspath(templateFile)
+
+        with open(path,'rb') as f:
+            data = f.read()
+
+        declaration = data[:data.find(b'?>')] if data.startswith(b'<?xml') else b''
+        if b'encoding' in declaration and re.search(rb'encoding=["\']utf-8["\']',declaration,re.I) is None:
+            return ET.parse(path)
+
+        sections = []
+        for parentTag,tag in self.lazySections:
+            bounds = findElementBytes(data,tag)
+            if bounds is not None:
+                sections.append((bounds[0],bounds[1],parentTag))
+
+        pieces = []
+        position = 0
+
+        for start,end,parentTag in sorted(sections):
+
+            if start < position: #inside the previous section
+                continue
+
+            segmentData = data[start:end]
+
+            ids = [int(x) for x in re.findall(rb' id="(\d+)"',segmentData)]
+            if len(ids) == 0 or ids != list(range(ids[0],ids[0]+len(ids))):
+                continue
+
+            references = set(int(x) for x in re.findall(rb' reference="(\d+)"',segmentData))
+            externalReferences = [str(x) for x in sorted(references) if not ids[0] <= x <= ids[-1]]
+
+            self.rawSegments.append(rawSegment(path,start,end,parentTag,ids[0],len(ids),externalReferences))
+
+            pieces.append(data[position:start])
+            pieces.append(('<%s n="%d" id="%d"/>' % (rawSegment.tag,len(self.rawSegments)-1,ids[0])).encode())
+            position = end
+
+        pieces.append(data[position:])
+
+        root = ET.fromstring(b''.join(pieces))
+
+        for placeholder in root.iter(rawSegment.tag):
+            self.rawSegments[int(placeholder.attrib['n'])].placeholder = placeholder
+
+        return ET.ElementTree(root)
+
+
+    def checkRawSegments(self):
+        #a placeholder must replace a child of the expected element (and not e.g. an element of the same name elsewhere)
+
+        for segment in self.rawSegments:
+            if self.parentMap[segment.placeholder].tag != segment.parentTag:
+                return False
+
+        return True
+
+
+    def findRawSegment(self,elemID):
+        #placeholder of the raw segment in which the id is defined
+
+        elemID = int(elemID)
+
+        for segment in self.rawSegments:
+            if segment.placeholder is not None:
+                firstID = int(segment.placeholder.attrib['id'])
+                if firstID <= elemID < firstID+segment.count:
+                    return segment.placeholder
+
+        return None
+
+
+    def materializeSegment(self,placeholder):
+        #parses a raw segment and puts its elements in the tree, in place of the placeholder
+
+        segment = self.rawSegments[int(placeholder.attrib['n'])]
+
+        element = ET.fromstring(segment.remapIDs(segment.read(),int(placeholder.attrib['id'])))
+        element.tail = placeholder.tail
+
+        parent = self.parentMap[placeholder]
+        index = list(parent).index(placeholder)
+
+        self.removeElement(parent,placeholder)
+        parent.insert(index,element)
+        self.registerSubtree(element,parent)
+
+        segment.placeholder = None
+
+        return element
+
+
+    def loadLazySections(self):
+        #parses all the sections left out by lazy=True, e.g. before editing them
+
+        for segment in self.rawSegments:
+            if segment.placeholder is not None:
+                self.materializeSegment(segment.placeholder)
+
+
     def setTemplatesDir(self,directory):
     
         self.templatesDir = directory
         self.refXMLs = { k:os.path.join(self.templatesDir,k+'_xml.xml') for k in ['wall','roof','floor','transparentElement','facade','wallInstance','floorInstance','roofPlane','roofInstance','opening','layer']}
 
-        self.materials = materials()
-        self.materials.read(os.path.join(self.templatesDir,'materials.csv'))
+        self.materialsFile = os.path.join(self.templatesDir,'materials.csv')
                 
 
+    @property
+    def materials(self):
+        #catalog of the templates directory, read on first use (see materials.shared)
+
+        return materials.shared(self.materialsFile)
+
+
     def setMeasurementMethod(self,method):
 
         acceptablemethodsdict={'projection':'PROJECTION','surfacesbrutes':'MEASUREMENT_GROSS_SURFACE','surfacesnettes':'MEASUREMENT'}
@@ -62,7 +573,7 @@ class PACEXML:
         priceElem=self.mainTree.find('.//advicePrice')
         if (priceElem is None):
             priceElem = ET.Element('advicePrice')
-            self.mainTree.getroot().append(priceElem)
+            self.appendElement(self.mainTree.getroot(),priceElem)
 
         priceElem.text=str(price)
 
@@ -82,7 +593,7 @@ class PACEXML:
             elem = ET.Element('freeFacadeCount')
         try:
             elem.text= valueDict[number]
-            buildingElem.append(elem)
+            self.appendElement(buildingElem,elem)
         except:
             print("error in set number of facades")
 
@@ -114,41 +625,108 @@ class PACEXML:
         #            ]
         #
         
-        for surface in surfacesList:
+        #all the elements are inserted at once (single id block, single renumbering of the main tree)
         
-            self.addConstructionElement(surface['type'],surface['label'],surface['description'],surface['environment'],surface['subtype'])
-            self.setGrossSurface(surface['label'],surface['grossArea'])
-            self.setGrossSurfaceMod(surface['label'],surface['grossAreaMod'])
+        for surface,elementsWithLabel in zip(surfacesList,self.insertSurfaces(surfacesList)):
+
+            for c in elementsWithLabel:
+                self.setElementGrossSurface(c,surface['grossArea'])
+                self.setElementGrossSurfaceMod(c,surface['grossAreaMod'])
 
     def addNetSurfaces(self,surfacesList):    
         
-        for surface in surfacesList:
-        
-            self.addConstructionElement(surface['type'],surface['label'],surface['description'],surface['environment'],surface['subtype'])
-        
+        for surface,elementsWithLabel in zip(surfacesList,self.insertSurfaces(surfacesList)):
         
             if (surface['type'] != 'transparentElement'):
-                self.setNetSurface(surface['label'],surface['grossArea'])
-                self.setNetSurfaceMod(surface['label'],surface['grossAreaMod'])
+                for c in elementsWithLabel:
+                    self.setElementNetSurface(c,surface['grossArea'])
+                    self.setElementNetSurfaceMod(c,surface['grossAreaMod'])
+
+
+    def insertSurfaces(self,surfacesList):
+        #builds and inserts the construction elements of surfacesList in one pass
+        #returns, for each surface, the elements carrying its label at the time it is added
+        #(areas are then set exactly as if the surfaces had been added one by one)
+
+        elements = [self.buildConstructionElement(surface['type'],surface['label'],surface['description'],surface['environment'],surface['subtype']) for surface in surfacesList]
+
+        self.insertConstructionElementsXML([surface['type'] for surface in surfacesList],elements)
+
+        newElements = set(elements)
+
+        knownElements = {}
+        elementsWithLabel = []
+
+        for surface,element in zip(surfacesList,elements):
+
+            label = surface['label']
+            if label not in knownElements:
+                knownElements[label] = [c for c in self.getConstructionElementsByLabel(label) if c not in newElements]
+
+            knownElements[label].append(element)
+            elementsWithLabel.append(list(knownElements[label]))
+
+        return elementsWithLabel
 
 
 
     def addFacadesAndSurfaces(self,facadesDict):
-        #pour methode des projections
-        
-        #a ecrire
-        
-        """ [  {"planType": "Roof|Wall|Floor",
-                "planName": "xxx",
-                "instances": {
-                       "M1": 100,
-                       "M2":  50
-                       }
-                },
-               { autre plans ..}
-           ]
-        """
-            
+        #pour methode des projections: every plane and its instances, with a single renumbering and reordering pass
+        #
+        #    [{"planType": "Wall", "planName": "N", "instances": {"M1": 100, "M2": 50}},
+        #     {"planType": "Roof", "planName": "S", "inclination": 35, "instances": {"T1": 80}},
+        #     {"planType": "Floor", "area": 120, "instances": {"P1": 60, "P2": 60}},
+        #     { autre plans ..}]
+        #
+        #planName is the orientation of the wall and roof planes (Direction of addFacade and addRoofPlane), their
+        #gross surface is "area" if given, the sum of the instances otherwise; floors need no planName, their
+        #instances go to the floor plane of the building, whose gross surface is only set if "area" is given
+        #returns the ids of the planes, in the order of facadesDict
+
+        #everything is checked before the tree is modified, so that a wrong plan does not leave half a building
+        for k,plan in enumerate(facadesDict):
+            planType = str(plan.get('planType','')).lower()
+            if planType not in ('wall','roof','floor'):
+                raise ValueError("Unknown planType '"+str(plan.get('planType'))+"', valid plan types are Wall, Roof and Floor")
+            if planType != 'floor' and 'planName' not in plan:
+                raise ValueError(str(plan['planType'])+" plane "+str(k)+" of facadesDict has no planName (orientation)")
+            if planType == 'roof' and 'inclination' not in plan:
+                raise ValueError("Roof plane '"+str(plan.get('planName'))+"' has no inclination")
+            for label in plan.get('instances',{}):
+                if self.findConstructionElementID(label,planType) is None:
+                    raise ValueError("Unknown "+planType+" label '"+str(label)+"' in plane '"+str(plan.get('planName'))+"'")
+
+        planes = []
+
+        #inside the batch, the reorders are postponed: one reorder and one renumbering when leaving it
+        with self.batch():
+            for plan in facadesDict:
+                planType = str(plan['planType']).lower()
+                instances = plan.get('instances',{})
+                area = plan.get('area',sum(instances.values()))
+
+                if planType == 'wall':
+                    planeID = self.addFacade(plan['planName'],area)
+                    for label,instanceArea in instances.items():
+                        self.addWallInstance(planeID,label,instanceArea)
+
+                elif planType == 'roof':
+                    planeID = self.addRoofPlane(plan['planName'],plan['inclination'],area)
+                    for label,instanceArea in instances.items():
+                        self.addRoofInstance(planeID,label,instanceArea)
+
+                else:
+                    if 'area' in plan:
+                        self.setFloorPlaneArea('INITIAL',plan['area'])
+                    for label,instanceArea in instances.items():
+                        self.addFloorInstance(label,instanceArea)
+                    planeID = self.getFloorPlane().attrib['id']
+
+                planes.append(self.getElementByID(planeID))
+
+        #ids after the renumbering of the batch
+        return [plane.attrib['id'] for plane in planes]
+
 
     def addFacade(self,Direction,area):
         
@@ -175,14 +753,9 @@ class PACEXML:
         wallPlanes = self.mainTree.find('.//wallPlanes[@id]')
         initial = wallPlanes.find('INITIAL')
         
-        existingFacades = self.getFacades()
-        latestFacadeID = self.getHighestID(existingFacades)
-        
-        latestNewID=self.renumberTreeOrElem(facadeElem,latestFacadeID+1)
-        #self.renumberTreeOrElem(self.mainTree,latestFacadeID+1,latestNewID+1)
-        self.renumberMainTreeFromID(latestFacadeID+1,latestNewID+1)
+        self.allocateIDs(facadeElem)
        
-        initial.append(facadeElem)
+        self.appendElement(initial,facadeElem)
         
         return facadeElem.attrib['id']
         
@@ -218,15 +791,10 @@ class PACEXML:
         roofPlanes = self.mainTree.find('.//roofPlanes[@id]')
         initial = roofPlanes.find('INITIAL')
         
-        existingRoofPlanes = self.getRoofPlanes()
-        latestRoofPlaneID = self.getHighestID(existingRoofPlanes)
-        
-        latestNewID=self.renumberTreeOrElem(roofPlane,latestRoofPlaneID+1)
-        self.renumberMainTreeFromID(latestRoofPlaneID+1,latestNewID+1)
-        #self.renumberTreeOrElem(self.mainTree,latestRoofPlaneID+1,latestNewID+1)
+        self.allocateIDs(roofPlane)
 
 
-        initial.append(roofPlane)
+        self.appendElement(initial,roofPlane)
         
         return roofPlane.attrib['id']
     
@@ -235,7 +803,7 @@ class PACEXML:
         
         wallID = self.findConstructionElementID(wallType,'wall')
         
-        facade = self.mainTree.find('.//*[@id="'+facadeID+'"]')
+        facade = self.getElementByID(facadeID)
         
        
 
@@ -256,13 +824,9 @@ class PACEXML:
 
         instancesList = facade.find('wallInstances')
         initial = instancesList.find('INITIAL')
-        latestID = self.getHighestID(initial)
 
-        self.renumberTreeOrElem(wallInstance,int(latestID)+1)
-
-        #Renumbering main tree
-        latestWallInstanceID = self.getHighestID(wallInstance)
-        self.renumberMainTreeFromID(latestID+1,latestWallInstanceID+1)
+        #Renumbering the instance and the main tree
+        self.allocateIDs(wallInstance)
 
 
         self.setObjectGrossSurface(wallInstance,area,'INITIAL')        
@@ -270,39 +834,38 @@ class PACEXML:
         wallInstance.find('shortDescription').text = wallType+suffix
 
         #Inserting the newly created instance
-        initial.append(wallInstance)       
+        self.appendElement(initial,wallInstance)
 
         # adding refrence to wallInstance in wallTree
         wallID = self.findConstructionElementID(wallType,'wall')
         
         
-        wallElem = self.mainTree.find('.//*[@id="'+str(wallID)+'"]')
+        wallElem = self.getElementByID(wallID)
 
         initWallInstances = wallElem.find('wallInstances').find('INITIAL')
-        newRef = ET.Element('com.hemmis.mrw.pace.model.skin.WallInstance',{'reference':str(latestID+1)})
-        initWallInstances.append(newRef)
+        newRef = ET.Element('com.hemmis.mrw.pace.model.skin.WallInstance',{'reference':wallInstance.attrib['id']})
+        self.appendElement(initWallInstances,newRef)
 
         
         #the problem here is that the reference to wall instance occurs before it is defined ! 
-        self.reorderIdsAndReferences()
+        self.scheduleReorder()
 
 
     def addRoofInstance(self,roofPlaneID,roofType,area,suffix=' instance'):
         
         roofID = self.findConstructionElementID(roofType,'roof')
 
-        roofPlane = self.mainTree.find('.//*[@id="'+roofPlaneID+'"]')
+        roofPlane = self.getElementByID(roofPlaneID)
 
         
         instancesList = roofPlane.find('.//roofInstances')
         initial = instancesList.find('INITIAL')
-        latestID = self.getHighestID(initial)
 
         roofInstance = self.getTemplateElement('roofInstance')
        
         initialOpaqueElem = roofInstance.find('opaqueElement').find('INITIAL')
         initialOpaqueElem.set('reference',roofID)
-        self.renumberTreeOrElem(roofInstance,int(latestID)+1)
+        self.allocateIDs(roofInstance)
         
         initialOpaqueElem = roofInstance.find('opaqueElement').find('INITIAL')
         initialOpaqueElem.set('reference',roofID)
@@ -314,43 +877,43 @@ class PACEXML:
         planeElem.attrib.pop('isCut')
 
 
-        #Renumbering main tree
-        latestroofInstanceID = self.getHighestID(roofInstance)
-        
-        self.renumberMainTreeFromID(latestID+1,latestroofInstanceID+1)
-        #self.renumberTreeOrElem(self.mainTree,latestroofInstanceID+1,latestroofInstanceID+1)
-
-
         self.setObjectGrossSurface(roofInstance,area,'INITIAL')        
    
         roofInstance.find('shortDescription').text = roofType+suffix
 
         #Inserting the newly created instance
-        initial.append(roofInstance)       
+        self.appendElement(initial,roofInstance)
 
         # adding refrence to roofInstance in roofTree
         roofID = self.findConstructionElementID(roofType,'roof')
 
                
-        roofElem = self.mainTree.find('.//*[@id="'+str(roofID)+'"]')
+        roofElem = self.getElementByID(roofID)
 
 
         initroofInstances = roofElem.find('roofInstances').find('INITIAL')
-        newRef = ET.Element('com.hemmis.mrw.pace.model.skin.RoofInstance',{'reference':str(latestID+1)})
-        initroofInstances.append(newRef)
+        newRef = ET.Element('com.hemmis.mrw.pace.model.skin.RoofInstance',{'reference':roofInstance.attrib['id']})
+        self.appendElement(initroofInstances,newRef)
 
         
         #the problem here is that the reference to roof instance occurs before it is defined ! 
-        self.reorderIdsAndReferences()
+        self.scheduleReorder()
 
 
-    def setFloorPlaneArea(self,situation,area):
+    def getFloorPlane(self):
 
         floorPlane = self.mainTree.find('.//floorPlane') #without annexes, this element is unique! However, it can be defined elsewhere
         
         if 'id' not in floorPlane.attrib.keys():
             #in case it is not defined in teh <floorPlane> elemtn, search for the element with the same id as the first reference
-            floorPlane = self.mainTree.find('.//*[@id="'+floorPlane.attrib['reference']+'"]')
+            floorPlane = self.getElementByID(floorPlane.attrib['reference'])
+
+        return floorPlane
+
+
+    def setFloorPlaneArea(self,situation,area):
+
+        floorPlane = self.getFloorPlane()
 
         self.setObjectGrossSurface(floorPlane,area,situation)        
 
@@ -367,11 +930,7 @@ class PACEXML:
 
     def getFloorPlaneArea(self,situation):
 
-        floorPlane = self.mainTree.find('.//floorPlane') #without annexes, this element is unique! However, it can be defined elsewhere
-        
-        if 'id' not in floorPlane.attrib.keys():
-            #in case it is not defined in teh <floorPlane> elemtn, search for the element with the same id as the first reference
-            floorPlane = self.mainTree.find('.//*[@id="'+floorPlane.attrib['reference']+'"]')
+        floorPlane = self.getFloorPlane()
 
         return float(floorPlane.find('grossSurface').find(situation).text)
 
@@ -380,11 +939,7 @@ class PACEXML:
                 
         floorID = self.findConstructionElementID(floorType,'floor')
 
-        floorPlane = self.mainTree.find('.//floorPlane') #without annexes, this element is unique! However, it can be defined elsewhere
-        
-        if 'id' not in floorPlane.attrib.keys():
-            #in case it is not defined in teh <floorPlane> elemtn, search for the element with the same id as the first reference
-            floorPlane = self.mainTree.find('.//*[@id="'+floorPlane.attrib['reference']+'"]')
+        floorPlane = self.getFloorPlane()
         
         floorPlaneID = floorPlane.attrib['id']
 
@@ -392,13 +947,12 @@ class PACEXML:
         instancesList = floorPlane.find('floorInstances')
         initial = instancesList.find('INITIAL')
         
-        latestID = self.getHighestID(initial)
 
         floorInstance = self.getTemplateElement('floorInstance')
        
         initialOpaqueElem = floorInstance.find('opaqueElement').find('INITIAL')
         initialOpaqueElem.set('reference',floorID)
-        self.renumberTreeOrElem(floorInstance,int(latestID)+1)
+        self.allocateIDs(floorInstance)
         
         initialOpaqueElem = floorInstance.find('opaqueElement').find('INITIAL')
         initialOpaqueElem.set('reference',floorID)
@@ -410,124 +964,175 @@ class PACEXML:
         planeElem.attrib.pop('isCut')
 
 
-        #Renumbering main tree
-        latestfloorInstanceID = self.getHighestID(floorInstance)
-        self.renumberMainTreeFromID(latestID+1,latestfloorInstanceID+1)
-        #self.renumberTreeOrElem(self.mainTree,latestID+1,latestfloorInstanceID+1)
-
-
         self.setObjectGrossSurface(floorInstance,area,'INITIAL')        
    
         floorInstance.find('shortDescription').text = floorType+suffix
 
         #Inserting the newly created instance
-        initial.append(floorInstance)       
+        self.appendElement(initial,floorInstance)
 
         # adding refrence to floorInstance in floorTree
         floorID = self.findConstructionElementID(floorType,'floor')
         
-        floorElem = self.mainTree.find('.//*[@id="'+str(floorID)+'"]')
+        floorElem = self.getElementByID(floorID)
 
         initfloorInstances = floorElem.find('floorInstances').find('INITIAL')
-        newRef = ET.Element('com.hemmis.mrw.pace.model.skin.FloorInstance',{'reference':str(latestID+1)})
-        initfloorInstances.append(newRef)
+        newRef = ET.Element('com.hemmis.mrw.pace.model.skin.FloorInstance',{'reference':floorInstance.attrib['id']})
+        self.appendElement(initfloorInstances,newRef)
         
-        self.reorderIdsAndReferences()
+        self.scheduleReorder()
 
         
     def reorderIdsAndReferences(self):
         #make sure that reference to an item does not appear before it is defined (element with "id" attribute)
         #if so, the two are inverted
-        #apply recursively, since any inversion can cause other inversions
-        
-        previousCorrection = False
-        
-        parent_map = {c: p for p in self.mainTree.iter() for c in p}
-        
-        knownIds = []
-        
-        for elem in self.mainTree.iter():
-            
-            if 'id' in elem.attrib.keys() :
-                knownIds.append(elem.attrib['id'])
-        
-                    
-            if ('reference' in elem.attrib.keys()):
-               
-                if elem.attrib['reference'] not in knownIds:
+        #an inversion only moves elements located after the reference, so the part of the tree already
+        #visited stays valid: instead of restarting from the root, the walk goes on where the reference was
+        #--> single pass, no recursion
 
-                    
-                    elemTag = str(elem.tag) #new instance
-                    
-                    parentElem = parent_map[elem]
-                    parentElem.remove(elem)
-                                       
-                    
-                    originalElement = self.mainTree.find('.//*[@id="'+elem.attrib['reference']+'"]')
-                    originalTag = str(originalElement.tag)
+        root = self.mainTree.getroot()
 
-                    
-                    if (elemTag != originalTag):
-        
-                        originalElement.tag = elemTag                        
-                        elem.tag = originalTag
+        self.counters['reorders'] += 1
+        if self.methodsTimes is not None:
+            self.counters['treeScans'] += 1
 
-                        if (originalElement.tag == 'INITIAL'):
-                            originalElement.attrib['class'] = originalTag
+        knownIds = set()
+        if 'id' in root.attrib:
+            knownIds.add(root.attrib['id'])
 
-                        if (elem.tag == 'INITIAL'):
-                            elem.attrib['class'] = elemTag
+        stack = [[root,0]] #[element, index of the next child to visit]
+        maxDepth = 1
 
-                    parentOfOriginal = parent_map[originalElement]
-                    parentOfOriginal.remove(originalElement)
-                    
-                    parentElem.append(originalElement)
-                    parentOfOriginal.append(elem)
+        while len(stack) > 0:
 
-                    
-                    previousCorrection=True
-    
-                    break
+            frame = stack[-1]
+            parentElem,i = frame
 
-            
-        if previousCorrection:
-            
-            self.reorderIdsAndReferences()
-            
-    
-    def findConstructionElementID(self,reference,elementType):
-                
-        if (elementType not in self.constructionElementsClasses.keys()):
-            print("Valid element types are",self.constructionElementsClasses.keys())
-            return
-        else:
-            paceClass = self.constructionElementsClasses[elementType]
-    
-        elementsOfClass = self.mainTree.findall('.//'+paceClass+'[@id]') + self.mainTree.findall('.//*[@class="'+paceClass+'"][@id]')
-               
-        for element in elementsOfClass:
-            
-            if (element.find('reference').text == reference):
-                return element.attrib['id']
-            
-        return None
-        
+            if i >= len(parentElem):
+                stack.pop()
+                continue
 
-    def findOpeningByName(self,openingName):
-        
-        openings = self.mainTree.findall('.//com.hemmis.mrw.pace.model.skin.Opening[@id]')
-        
-        
-        for o in openings:
-            if o.find('shortDescription').text == openingName:
-                return o
-            
-        return None
-    
+            elem = parentElem[i]
 
-    def getHighestID(self,element):
-        #get last ID of element subtree
+            if elem.tag == rawSegment.tag:
+
+                segment = self.rawSegments[int(elem.attrib['n'])]
+
+                #a definition referenced by the segment comes after it: only a parsed segment can be reordered
+                if any(p.attrib['reference'] not in knownIds and self.getElementByID(p.attrib['reference']) is not None for p in segment.proxies.values()):
+                    self.materializeSegment(elem)
+                    continue
+
+                firstID = int(elem.attrib['id'])
+                knownIds.update(str(x) for x in range(firstID,firstID+segment.count))
+
+                frame[1] = i+1
+                continue
+
+            if 'reference' in elem.attrib:
+
+                reference = elem.attrib['reference']
+
+                if reference not in knownIds and reference != elem.attrib.get('id'):
+
+                    placeholder = self.findRawSegment(reference) if len(self.rawSegments) > 0 else None
+
+                    if placeholder is not None:
+                        self.materializeSegment(placeholder)
+
+                    originalElement = self.getElementByID(reference)
+
+                    if originalElement is not None:
+                        self.invertReferenceAndDefinition(elem,originalElement)
+                        #elem has been removed, the next sibling is now at index i
+                        continue
+
+            if 'id' in elem.attrib:
+                knownIds.add(elem.attrib['id'])
+
+            frame[1] = i+1
+            stack.append([elem,0])
+
+            if len(stack) > maxDepth:
+                maxDepth = len(stack)
+
+        self.counters['reorderMaxDepth'] = max(self.counters['reorderMaxDepth'],maxDepth)
+
+
+    def invertReferenceAndDefinition(self,elem,originalElement):
+        #the definition takes the place of the reference (at the end of its parent) and conversely
+
+        elemTag = str(elem.tag) #new instance
+        originalTag = str(originalElement.tag)
+
+        if (elemTag != originalTag):
+
+            originalElement.tag = elemTag
+            elem.tag = originalTag
+
+            if (originalElement.tag == 'INITIAL'):
+                originalElement.attrib['class'] = originalTag
+
+            if (elem.tag == 'INITIAL'):
+                elem.attrib['class'] = elemTag
+
+        parentElem = self.parentMap[elem]
+        parentOfOriginal = self.parentMap[originalElement]
+
+        self.renumberPending = True
+        self.counters['reorderInversions'] += 1
+
+        parentElem.remove(elem)
+        parentOfOriginal.remove(originalElement)
+
+        parentElem.append(originalElement)
+        parentOfOriginal.append(elem)
+
+        self.parentMap[originalElement] = parentElem
+        self.parentMap[elem] = parentOfOriginal
+
+    
+    def findConstructionElementID(self,reference,elementType):
+                
+        if (elementType not in self.constructionElementsClasses.keys()):
+            print("Valid element types are",self.constructionElementsClasses.keys())
+            return
+    
+        elementsWithLabel = self.labelIndex.get((elementType,reference),[])
+
+        if len(elementsWithLabel) == 0:
+            return None
+
+        if len(elementsWithLabel) > 1:
+            raise ValueError("Duplicate "+elementType+" label '"+str(reference)+"' ("+str(len(elementsWithLabel))+" construction elements)")
+
+        return elementsWithLabel[0].attrib['id']
+
+
+    def getDuplicateLabels(self):
+        #(elementType, label) --> number of construction elements sharing that label
+
+        return {k:len(v) for k,v in self.labelIndex.items() if len(v) > 1}
         
+
+    def findOpeningByName(self,openingName):
+        
+        openings = self.mainTree.findall('.//com.hemmis.mrw.pace.model.skin.Opening[@id]')
+        
+        
+        for o in openings:
+            if o.find('shortDescription').text == openingName:
+                return o
+            
+        return None
+    
+
+    def getHighestID(self,element):
+        #get last ID of element subtree
+        
+        if element is self.mainTree:
+            return self.highestID
+
         elementsWithID = element.findall('.//*[@id]')
 
         if (len(elementsWithID) > 0 ):
@@ -545,6 +1150,13 @@ class PACEXML:
     
     def addConstructionElement(self,elementType,label,description,environment,subtype):
 
+        elementXMLElement = self.buildConstructionElement(elementType,label,description,environment,subtype)
+
+        self.insertConstructionElementXML(elementType,elementXMLElement)
+
+
+    def buildConstructionElement(self,elementType,label,description,environment,subtype):
+
         #environment = OPEN_AIR, NON_HEATED_SPACE,GROUND,_WITH_OPENINGS,CELLAR_WITH_OPENINGS,CELLAR_WITHOUT_OPENINGS,HEATED_SPACE        
         
         elementXMLElement = self.getTemplateElement(elementType)
@@ -570,12 +1182,12 @@ class PACEXML:
 
         self.setSubType(elementXMLElement,elementType,subtype)
 
-        self.insertConstructionElementXML(elementType,elementXMLElement)
+        return elementXMLElement
 
 
     def addPredefinedConstructionElement(self,elementType,label,description,environment,elementTemplateDescription):
 
-        elementXMLElement = self.elemsTemplatesDict[elementType][elementTemplateDescription]
+        elementXMLElement = self.getPredefinedTemplateElement(elementType,elementTemplateDescription)
         elementXMLElement.find('reference').text = label
         elementXMLElement.find('shortDescription').text = description
         elementXMLElement.find('environment').text = environment
@@ -602,28 +1214,44 @@ class PACEXML:
 
     def insertConstructionElementXML(self,elementType,elementXMLElement):        
         
-        constructionElements = self.getConstructionElements()
-        latestConstructionElementID = self.getHighestID(constructionElements)
+        self.insertConstructionElementsXML([elementType],[elementXMLElement])
+
+
+    def insertConstructionElementsXML(self,elementTypes,elementXMLElements):
+        #elements are given one contiguous block of ids, the main tree is renumbered once for all of them
+        #a label can only be used once per element type (findConstructionElementID could not choose between them),
+        #this is checked before the tree is modified
 
-        latestAddedID=self.renumberTreeOrElem(elementXMLElement,latestConstructionElementID+1)
-        self.renumberMainTreeFromID(latestConstructionElementID+1,latestAddedID+1)
+        newLabels = set()
+        for elementType,elementXMLElement in zip(elementTypes,elementXMLElements):
+            key = (elementType,elementXMLElement.findtext('reference'))
+            if key in newLabels or len(self.labelIndex.get(key,[])) > 0:
+                raise ValueError("Duplicate "+elementType+" label '"+str(key[1])+"'")
+            newLabels.add(key)
 
-        constructionElements.append(elementXMLElement)
+        constructionElements = self.getConstructionElements()
+        self.allocateIDsBlock(elementXMLElements)
 
         pacetags={ 'wall':'walls',
                    'roof':'roofs',
                    'floor':'floors',
                    'transparentElement':'transparentElements'}
 
-        #There are lists of constructions elements elsewhere in the file, they need to be updated
-        elemlist=self.mainTree.find('.//skin[@id]').find(pacetags[elementType])
-        ET.SubElement(elemlist, self.constructionElementsClasses[elementType], reference=elementXMLElement.attrib['id'])
+        skin = self.mainTree.find('.//skin[@id]')
+
+        for elementType,elementXMLElement in zip(elementTypes,elementXMLElements):
+
+            self.appendElement(constructionElements,elementXMLElement)
+
+            #There are lists of constructions elements elsewhere in the file, they need to be updated
+            elemlist=skin.find(pacetags[elementType])
+            self.addSubElement(elemlist, self.constructionElementsClasses[elementType], {'reference':elementXMLElement.attrib['id']})
 
 
     def setWallDetails(self,label,thickness=0.30,basisComposition='Pierre < 40',layers=[]):
 
         wallId = self.findConstructionElementID(label,'wall')
-        wallElement = self.mainTree.find('.//*[@id="'+wallId+'"]')
+        wallElement = self.getElementByID(wallId)
     
         wallSpecs = wallElement.find('wallSpecs')
         
@@ -639,12 +1267,9 @@ class PACEXML:
         constructionElementLayers = constructionElement.find('.//layers')
         constructionElementOpaqueStructure = constructionElement.find('.//opaqueStructure')
     
-        maxID = self.getHighestID(constructionElementLayers)
-        newLayerID = maxID+1
-    
         layerElement = self.getTemplateElement('layer')
     
-        self.renumberTreeOrElem(layerElement,newLayerID)
+        self.allocateIDs(layerElement)
 
  
         layerElement.find(".//opaqueStructure").attrib['reference']=constructionElementOpaqueStructure.attrib['id']
@@ -697,12 +1322,197 @@ class PACEXML:
             #        <insulationStructure>WOOD_FRAME</insulationStructure>
 
 
-                
-        latestLayerID = self.getHighestID(layerElement)        
-        self.renumberMainTreeFromID(newLayerID,latestLayerID+1)
 
         
-        constructionElementLayers.append(layerElement)
+        self.appendElement(constructionElementLayers,layerElement)
+
+
+    def getUValues(self,lambdas=None):
+        #U-values of all the construction elements of the tree, computed at once with numpy from their specs and layers:
+        #R = rvalueIn + rvalueOut + the layers, or for an element without layers, the simplified composition of its
+        #specs: base structure (thickness/lamdaBase, or rvalueBase) + rvalueCavity + rvalueInsulation1 and 2
+        #a layer counts for its manual rvalue, or else thickness/lambda, lambda being the manual one, or else the one
+        #of lambdas (material id --> lambda, materials.csv has no conductivities); the lambda in the file is not used
+        #for a layer without manual lambda, addLayer leaves the one of the layer template there whatever the material
+        #layers without lambda count for the rvalue computed by PACE (nan if there is none, and then for their element)
+        #a manual uvalue replaces the computed one, transparent elements have the uvalue of their specs
+        #PACE keeps one composition per construction element, the renovated composition of the SECOND situation
+        #is another construction element (see getTransmissionLosses)
+        #returns numpy columns: id, type, label, layers (number of), rvalueLayers, rvalueTotal, uvalue,
+        #environmentWeightFactor
+
+        if lambdas is None:
+            lambdas = {}
+
+        elements = sorted((e for elementsWithLabel in self.labelIndex.values() for e in elementsWithLabel),key=lambda e:int(e.attrib['id']))
+
+        specsColumns = ['rvalueIn','rvalueOut','thickness','lamdaBase','rvalueBase','rvalueCavity','rvalueInsulation1','rvalueInsulation2',
+                        'uvalue','environmentWeightFactor']
+        specs = np.full((len(elements),len(specsColumns)),np.nan)
+        manualU = np.zeros(len(elements),dtype=bool)
+        transparent = np.zeros(len(elements),dtype=bool)
+        types = []
+        layers = [] #owner, thickness, lamda, rvalue, lamdaManually, rvalueManually, lambda of the catalog
+
+        for k,e in enumerate(elements):
+
+            elementType = self.constructionElementsTypes.get(e.tag,self.constructionElementsTypes.get(e.attrib.get('class')))
+            types.append(elementType)
+            transparent[k] = elementType == 'transparentElement'
+
+            elementSpecs = e.find(elementType+'Specs/CURRENT__STATE')
+            if elementSpecs is None:
+                continue
+
+            specs[k] = [floatOrNan(elementSpecs.findtext(name)) for name in specsColumns]
+            manualU[k] = elementSpecs.findtext('uvalueManually') == 'true'
+
+            for layer in elementSpecs.findall('opaqueStructure/layers/*'):
+                if 'reference' in layer.attrib:
+                    layer = self.getElementByID(layer.attrib['reference'])
+                layers.append([k,floatOrNan(layer.findtext('thickness')),floatOrNan(layer.findtext('lamda')),floatOrNan(layer.findtext('rvalue')),
+                               layer.findtext('lamdaManually') == 'true',layer.findtext('rvalueManually') == 'true',
+                               lambdas.get(layer.findtext('material/id'),np.nan)])
+
+        layers = np.array(layers,dtype=float).reshape(-1,7)
+        owner = layers[:,0].astype(int)
+        thickness,lamda,rvalue,lamdaManually,rvalueManually,catalogLamda = layers[:,1:].T
+
+        lamda = np.where(lamdaManually == 1,lamda,catalogLamda)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            layersR = np.where(rvalueManually == 1,rvalue,np.where(lamda > 0,thickness/lamda,rvalue))
+
+        #sums per element, nan if one of its layers is unknown
+        rvalueLayers = np.bincount(owner,weights=np.nan_to_num(layersR),minlength=len(elements)).astype(float)
+        rvalueLayers[np.bincount(owner,weights=np.isnan(layersR),minlength=len(elements)) > 0] = np.nan
+
+        rvalueIn,rvalueOut,thicknessBase,lamdaBase,rvalueBase,rvalueCavity,rvalueInsulation1,rvalueInsulation2,uvalue,weightFactor = specs.T
+        layersCount = np.bincount(owner,minlength=len(elements))
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            rvalueBase = np.where((thicknessBase > 0) & (lamdaBase > 0),thicknessBase/lamdaBase,rvalueBase)
+            rvalueSpecs = rvalueBase+np.nan_to_num(rvalueCavity)+np.nan_to_num(rvalueInsulation1)+np.nan_to_num(rvalueInsulation2)
+            rvalueTotal = rvalueIn+rvalueOut+np.where(layersCount > 0,rvalueLayers,rvalueSpecs)
+            computedU = 1/rvalueTotal
+
+        return {'id':np.array([e.attrib['id'] for e in elements],dtype=str),
+                'type':np.array(types,dtype=str),
+                'label':np.array([e.findtext('reference','') for e in elements],dtype=str),
+                'layers':layersCount,
+                'rvalueLayers':rvalueLayers,
+                'rvalueTotal':np.where(transparent,np.nan,rvalueTotal),
+                'uvalue':np.where(manualU | transparent,uvalue,computedU),
+                'environmentWeightFactor':weightFactor}
+
+
+    def getTransmissionLosses(self,lambdas=None):
+        #transmission losses H_T = sum of A.U.b over the construction elements, for both situations, with numpy
+        #A: gross surface (manual, or sum of the instances of the wall, roof and floor planes) minus the surfaces of the
+        #openings of the element, or its netSurface if set manually (net method); surfaces of the openings for the windows
+        #a situation without its own list or value (no SECOND) is the same as INITIAL; an instance can use another
+        #construction element in the SECOND situation; a manual ht of the specs replaces A.U.b
+        #U and b: see getUValues
+        #returns {'elements': numpy columns id, type, label, uvalue, environmentWeightFactor, areaInitial, areaSecond,
+        #htInitial, htSecond (W/K), 'htInitial': total, 'htSecond': total}
+
+        uvalues = self.getUValues(lambdas)
+        indexes = {elemID:k for k,elemID in enumerate(uvalues['id'])}
+        situations = ['INITIAL','SECOND']
+
+        def resolve(e):
+            if e is None:
+                return None
+            if 'reference' in e.attrib:
+                return self.getElementByID(e.attrib['reference'])
+            if 'uniqueReference' in e.attrib:
+                elementType = self.constructionElementsTypes.get(e.attrib.get('class'))
+                elementsWithLabel = self.labelIndex.get((elementType,e.attrib['uniqueReference']),[])
+                return elementsWithLabel[0] if len(elementsWithLabel) > 0 else None
+            return e
+
+        def situation(e,name):
+            if e is None:
+                return None
+            s = e.find(name)
+            return s if s is not None else e.find('INITIAL')
+
+        def text(e,name):
+            s = situation(e,name)
+            if s is not None and 'reference' in s.attrib:
+                s = self.getElementByID(s.attrib['reference'])
+            if s is None:
+                return None
+            if len(s) > 0:
+                return s.findtext('CURRENT__STATE')
+            return s.text
+
+        def value(e,name):
+            return floatOrNan(text(e,name))
+
+        def items(e,name):
+            s = situation(e,name)
+            return [resolve(item) for item in s] if s is not None else []
+
+        def elementIndex(e,name):
+            ce = resolve(situation(e,name))
+            return indexes.get(ce.attrib.get('id'),-1) if ce is not None else -1
+
+        #surfaces of the instances and of the openings: [element index, situation index, surface]
+        instances = []
+        openings = []
+
+        skin = self.mainTree.find('.//skin')
+        planes = [(plane,'wallInstances') for plane in items(skin.find('wallPlanes'),'INITIAL')]
+        planes += [(plane,'roofInstances') for plane in items(skin.find('roofPlanes'),'INITIAL')]
+        planes.append((resolve(skin.find('floorPlane')),'floorInstances'))
+
+        elements = sorted((e for elementsWithLabel in self.labelIndex.values() for e in elementsWithLabel),key=lambda e:indexes[e.attrib['id']])
+
+        for s,name in enumerate(situations):
+
+            for plane,instancesTag in planes:
+                if plane is not None:
+                    for instance in items(plane.find(instancesTag),name):
+                        instances.append([elementIndex(instance.find('opaqueElement'),name),s,value(instance.find('grossSurface'),name)])
+
+            for k,e in enumerate(elements):
+                for opening in items(e.find('openings'),name):
+                    openings.append([k,s,value(opening.find('surface'),name)])
+
+        def sums(rows):
+            rows = np.array(rows,dtype=float).reshape(-1,3)
+            rows = rows[(rows[:,0] >= 0) & np.isfinite(rows[:,2])]
+            return np.stack([np.bincount(rows[rows[:,1] == s,0].astype(int),weights=rows[rows[:,1] == s,2],minlength=len(elements)) for s in range(2)],axis=1)
+
+        instancesAreas = sums(instances)
+        openingsAreas = sums(openings)
+
+        #manual gross and net surfaces, and manual ht, of the construction elements
+        manualGross = np.full((len(elements),2),np.nan)
+        manualNet = np.full((len(elements),2),np.nan)
+        manualHT = np.full((len(elements),2),np.nan)
+
+        for k,e in enumerate(elements):
+            elementSpecs = e.find(uvalues['type'][k]+'Specs/CURRENT__STATE')
+            for s,name in enumerate(situations):
+                if text(e.find('grossSurfaceManually'),name) == 'true':
+                    manualGross[k,s] = value(e.find('grossSurface'),name)
+                if text(e.find('netSurfaceManually'),name) == 'true':
+                    manualNet[k,s] = value(e.find('netSurface'),name)
+                if elementSpecs is not None and text(elementSpecs.find('htManually'),name) == 'true':
+                    manualHT[k,s] = value(elementSpecs.find('ht'),name)
+
+        transparent = (uvalues['type'] == 'transparentElement')[:,None]
+        grossAreas = np.where(np.isnan(manualGross),instancesAreas,manualGross)
+        areas = np.where(transparent,openingsAreas,grossAreas-openingsAreas)
+        areas = np.where(np.isnan(manualNet),areas,manualNet)
+        ht = areas*(uvalues['uvalue']*np.nan_to_num(uvalues['environmentWeightFactor'],nan=1.0))[:,None]
+        ht = np.where(np.isnan(manualHT),ht,manualHT)
+
+        elements = {name:uvalues[name] for name in ['id','type','label','uvalue','environmentWeightFactor']}
+        elements.update(areaInitial=areas[:,0],areaSecond=areas[:,1],htInitial=ht[:,0],htSecond=ht[:,1])
+
+        return {'elements':elements,'htInitial':np.nansum(ht[:,0]),'htSecond':np.nansum(ht[:,1])}
 
 
     def addOpeningGrossMethod(self,opening_name,wallType,openingtype,direction,inclination=90):
@@ -710,8 +1520,7 @@ class PACEXML:
         
         openingElement = self.getTemplateElement('opening')
 
-        lastFileId = self.getHighestID(self.mainTree)
-        self.renumberTreeOrElem(openingElement,lastFileId+1)
+        self.allocateIDs(openingElement)
 
     
         skinID = self.mainTree.find('.//skin[@id]').attrib['id']
@@ -749,39 +1558,39 @@ class PACEXML:
         
         openings=self.mainTree.find('.//skin[@id]/openings')
         initial=openings.find('./INITIAL')
-        initial.append(openingElement)
+        self.appendElement(initial,openingElement)
         
         
-        wallelem=self.mainTree.find('.//*[@id="'+walltypeid+'"]')
-        transelem=self.mainTree.find('.//*[@id="'+openingtypeid+'"]')
+        wallelem=self.getElementByID(walltypeid)
+        transelem=self.getElementByID(openingtypeid)
         
         
         wopeningslist=wallelem.find('./openings/INITIAL')
-        ET.SubElement(wopeningslist, openingElement.tag, {'reference':openingElement.attrib['id']})
+        self.addSubElement(wopeningslist, openingElement.tag, {'reference':openingElement.attrib['id']})
         
         topeningslist=transelem.find('./openings/INITIAL')
-        ET.SubElement(topeningslist, openingElement.tag, {'reference':openingElement.attrib['id']})
+        self.addSubElement(topeningslist, openingElement.tag, {'reference':openingElement.attrib['id']})
 
 
         # if we dont add the openings in second situation if makes some bugs... 
         wopeningsListSecond = wallelem.find('./openings/SECOND')      
         if (wopeningsListSecond == None):
             wopeningsListSecond = ET.Element('SECOND')
-            wallelem.find('./openings').append(wopeningsListSecond)
+            self.appendElement(wallelem.find('./openings'),wopeningsListSecond)
  
         ref = ET.Element(openingElement.tag,{'reference':openingElement.attrib['id']})
-        wopeningsListSecond.append(ref)
+        self.appendElement(wopeningsListSecond,ref)
 
         topeningsListSecond = transelem.find('./openings/SECOND')      
         if (topeningsListSecond == None):
             topeningsListSecond = ET.Element('SECOND')
-            transelem.find('./openings').append(topeningsListSecond)
+            self.appendElement(transelem.find('./openings'),topeningsListSecond)
  
         ref = ET.Element(openingElement.tag,{'reference':openingElement.attrib['id']})
-        topeningsListSecond.append(ref)
+        self.appendElement(topeningsListSecond,ref)
 
 
-        self.reorderIdsAndReferences()
+        self.scheduleReorder()
 
 
     def addOpeningNetMethod(self,opening_name,openingtype,direction,inclination=90,area=1):
@@ -791,8 +1600,7 @@ class PACEXML:
         
         openingElement = self.getTemplateElement('opening')
 
-        lastFileId = self.getHighestID(self.mainTree)
-        self.renumberTreeOrElem(openingElement,lastFileId+1)
+        self.allocateIDs(openingElement)
     
         skinID = self.mainTree.find('.//skin[@id]').attrib['id']
         
@@ -817,29 +1625,29 @@ class PACEXML:
         #on l'ajoute a l'endroit le plus logique, on reorganisera après
         openings=self.mainTree.find('.//skin[@id]/openings')
         initial=openings.find('./INITIAL')
-        initial.append(openingElement)
+        self.appendElement(initial,openingElement)
         
-        transelem=self.mainTree.find('.//*[@id="'+openingtypeid+'"]')
+        transelem=self.getElementByID(openingtypeid)
         
         topeningslist=transelem.find('./openings/INITIAL')
-        ET.SubElement(topeningslist, openingElement.tag, {'reference':openingElement.attrib['id']})
+        self.addSubElement(topeningslist, openingElement.tag, {'reference':openingElement.attrib['id']})
 
 
         
         topeningsListSecond = transelem.find('./openings/SECOND')      
         if (topeningsListSecond == None):
             topeningsListSecond = ET.Element('SECOND')
-            transelem.find('./openings').append(topeningsListSecond)
+            self.appendElement(transelem.find('./openings'),topeningsListSecond)
 
 
         openings=self.mainTree.find('.//skin[@id]/openings')
         second=openings.find('./SECOND')
         ref = ET.Element(openingElement.tag,{'reference':openingElement.attrib['id']})
-        second.append(ref)
+        self.appendElement(second,ref)
         
         
         ref = ET.Element(openingElement.tag,{'reference':openingElement.attrib['id']})
-        topeningsListSecond.append(ref)
+        self.appendElement(topeningsListSecond,ref)
 
         #building --> skin --> openings --> INITIAL
         #building --> skin --> openings --> SECOND
@@ -848,7 +1656,7 @@ class PACEXML:
         #building --> skin --> constructionElements --> transparentElements --> element XX --> openings --> SECOND
         
 
-        self.reorderIdsAndReferences()
+        self.scheduleReorder()
 
 
     def addOpeningNetMethodMod(self,opening_name,openingtype,direction,inclination=90,area=1):
@@ -858,8 +1666,7 @@ class PACEXML:
         openingElement = self.getTemplateElement('opening')
         openingElement.find('./state').text='ADDED'
 
-        lastFileId = self.getHighestID(self.mainTree)
-        self.renumberTreeOrElem(openingElement,lastFileId+1)
+        self.allocateIDs(openingElement)
     
         skinID = self.mainTree.find('.//skin[@id]').attrib['id']
         
@@ -894,25 +1701,25 @@ class PACEXML:
         #on l'ajoute a l'endroit le plus logique, on reorganisera après
         openings=self.mainTree.find('.//skin[@id]/openings')
         second=openings.find('./SECOND')
-        second.append(openingElement)
+        self.appendElement(second,openingElement)
         
-        transelem=self.mainTree.find('.//*[@id="'+openingtypeid+'"]')
+        transelem=self.getElementByID(openingtypeid)
       
         topeningslist=transelem.find('./openings/SECOND')
-        ET.SubElement(topeningslist, openingElement.tag, {'reference':openingElement.attrib['id']})
+        self.addSubElement(topeningslist, openingElement.tag, {'reference':openingElement.attrib['id']})
       
         openingtypeid = openingElement.find('transparentElement').find('SECOND').attrib['reference']
-        transelem=self.mainTree.find('.//*[@id="'+openingtypeid+'"]')
+        transelem=self.getElementByID(openingtypeid)
         netSurface = transelem.find('netSurface')
         
-        second = ET.Element('SECOND',{'class':'com.hemmis.mrw.pace.model.ObservableSpecProperty','id':'99999','v':'2'})
+        second = ET.Element('SECOND',{'class':'com.hemmis.mrw.pace.model.ObservableSpecProperty','id':self.getNewID(),'v':'2'})
         cstate = ET.Element('CURRENT__STATE',{'class':'java.math.BigDecimal'})
         cstate.text = '0'
         second.append(cstate)
-        netSurface.append(second)
+        self.appendElement(netSurface,second)
         
 
-        self.reorderIdsAndReferences()
+        self.scheduleReorder()
 
 
     def setOpeningAreaMod(self,openingName,modArea):
@@ -923,21 +1730,21 @@ class PACEXML:
         
         second = ET.Element('SECOND',{'class':"java.math.BigDecimal"})
         second.text = str(modArea)
-        openingElement.find('./surface').append(second)
+        self.appendElement(openingElement.find('./surface'),second)
 
 
         #find transparentElement and updat its surface
         #remove it from transparent element list
         openingtypeid = openingElement.find('transparentElement').find('INITIAL').attrib['reference']
-        transelem=self.mainTree.find('.//*[@id="'+openingtypeid+'"]')
+        transelem=self.getElementByID(openingtypeid)
         netSurface = transelem.find('netSurface')
         
-        second = ET.Element('SECOND',{'class':'com.hemmis.mrw.pace.model.ObservableSpecProperty','id':'99999','v':'2'})
+        second = ET.Element('SECOND',{'class':'com.hemmis.mrw.pace.model.ObservableSpecProperty','id':self.getNewID(),'v':'2'})
         cstate = ET.Element('CURRENT__STATE',{'class':'java.math.BigDecimal'})
         cstate.text = '0'
         
         second.append(cstate)
-        netSurface.append(second)
+        self.appendElement(netSurface,second)
 
 
     def deleteOpeningMod(self,openingName):
@@ -951,14 +1758,14 @@ class PACEXML:
         openings=self.mainTree.find('.//skin[@id]/openings')
         secondOpeningsList = openings.find('SECOND')
         elementToDelete = secondOpeningsList.find('*[@reference="'+openingID+'"]')
-        secondOpeningsList.remove(elementToDelete)
+        self.removeElement(secondOpeningsList,elementToDelete)
 
         #remove it from transparent element list
         openingtypeid = openingElement.find('transparentElement').find('INITIAL').attrib['reference']
-        transelem=self.mainTree.find('.//*[@id="'+openingtypeid+'"]')
+        transelem=self.getElementByID(openingtypeid)
         secondOpeningsList = transelem.find('openings').find('SECOND') 
         elementToDelete = secondOpeningsList.find('.//*[@reference="'+openingID+'"]')
-        secondOpeningsList.remove(elementToDelete)
+        self.removeElement(secondOpeningsList,elementToDelete)
         
                 
         
@@ -1025,30 +1832,27 @@ class PACEXML:
     
     def getTemplateElement(self,elementType):
      
-        subTree = ET.parse(self.refXMLs[elementType])  
-
-        return subTree.getroot()
+        return templatesCache.getElement(self.refXMLs[elementType])
 
 
     def loadPredefinedTemplateElements(self,templateFile):
+        #the database is indexed once (see constructionElementsLibrary), the elements are parsed when first used
         
-        templateXML = PACEXML(templateFile)
-        templateElems = templateXML.getConstructionElements() #GET ALL CE FROM TEMPLATE
+        self.predefinedLibrary = constructionElementsLibrary.shared(templateFile,self.constructionElementsClasses)
 
-        self.elemsTemplatesDict={}
+        self.elemsTemplatesDict = {elementType:{} for elementType in self.predefinedLibrary.elements.keys()}
 
-        for elementType in ['wall','floor','roof','transparentElement']:
 
-            paceClass = self.constructionElementsClasses[elementType]
-  
-            elementsOfClass = templateElems.findall('.//'+paceClass+'[@id]') + templateElems.findall('.//*[@class="'+paceClass+'"][@id]')
+    def getPredefinedTemplateElement(self,elementType,description):
+        #new copy of a library element: elemsTemplatesDict keeps the parsed prototypes, which are never modified,
+        #so that the same library element can be added several times
 
-            elemsDict = {}
-            
-            for elem in elementsOfClass:
-                elemsDict[elem.find('.//shortDescription').text] = elem
-                
-            self.elemsTemplatesDict[elementType] = elemsDict
+        elemsDict = self.elemsTemplatesDict[elementType]
+
+        if description not in elemsDict:
+            elemsDict[description] = self.predefinedLibrary.getElement(elementType,description)
+
+        return cloneElement(elemsDict[description])
 
     """def getPredefinedTemplateElements(self):
         
@@ -1057,16 +1861,11 @@ class PACEXML:
     
     def getPredefinedTemplatesElementsList(self):
         
-        localDict = {}
-        
-        for elemType,elemDict in self.elemsTemplatesDict.items():
-            localDict[elemType] = list(elemDict.keys())
-
-        return localDict
+        return self.predefinedLibrary.getDescriptions()
         
     def renumberTreeOrElem(self,TreeOrElement,newStartID):
     
-        if (type(TreeOrElement) == type(ET.ElementTree())):       
+        if hasattr(TreeOrElement,'getroot'):       
             element = TreeOrElement.getroot() 
         else:
             element = TreeOrElement
@@ -1086,10 +1885,25 @@ class PACEXML:
             
             newid+=1
             oldID_to_newID_dict[e.attrib['id']]=str(newid)
-            e.attrib['id']=str(newid)
+
+            if e.tag == rawSegment.tag:
+                #the other ids of the segment follow its first one
+                firstID = int(e.attrib['id'])
+                count = self.rawSegments[int(e.attrib['n'])].count
+                for k in range(1,count):
+                    oldID_to_newID_dict[str(firstID+k)]=str(newid+k)
+                e.attrib['id']=str(newid)
+                newid+=count-1
+            else:
+                e.attrib['id']=str(newid)
 
         elementsWithRef = element.findall(".//*[@reference]") 
 
+        if element is self.mainTree.getroot():
+            if self.methodsTimes is not None:
+                self.counters['treeScans'] += 2
+            elementsWithRef += [p for segment in self.rawSegments if segment.placeholder is not None for p in segment.proxies.values()]
+
         for e in elementsWithRef:
             if e.attrib['reference'] in oldID_to_newID_dict.keys(): 
                 e.attrib['reference']=oldID_to_newID_dict[e.attrib['reference']]  
@@ -1097,142 +1911,141 @@ class PACEXML:
         return newid
 
 
-    def renumberMainTreeFromID(self,startID,newStartID):
-        #should somehow be merged with the function above, but issues encountered when trying... 
-        
-        oldID_to_newID_dict = {}
+    def allocateIDs(self,element):
+        #gives a new element ids above the highest id of the main tree, the ids of the main tree are left as is
+        #they are put back in document order by the renumbering of finalize (writePaceFile)
 
-        elementsWithID  = self.mainTree.findall(".//*[@id]")          
-       
-        newid = newStartID
-                
-        for e in elementsWithID:        
-        
-            if int(e.attrib['id']) >= startID :
-                oldID_to_newID_dict[e.attrib['id']] =str(newid)                 
-                e.attrib['id']=str(newid)
-                newid+=1
+        return self.allocateIDsBlock([element])
 
-        elementsWithRef = self.mainTree.findall(".//*[@reference]") 
 
-        for e in elementsWithRef:
-            if e.attrib['reference'] in oldID_to_newID_dict.keys(): 
-                e.attrib['reference']=oldID_to_newID_dict[e.attrib['reference']]  
+    def allocateIDsBlock(self,elements):
+        #same as allocateIDs, for several elements numbered one after the other
+
+        lastID = self.highestID
+
+        for element in elements:
+            lastID = self.renumberTreeOrElem(element,lastID+1)
+
+        self.counters['allocatedIDs'] += lastID-self.highestID
+        self.highestID = lastID
+        self.renumberPending = True
+
+        return lastID
+
+
+    def scheduleReorder(self):
+
+        if self.isDeferred():
+            self.reorderPending = True
+        else:
+            self.reorderIdsAndReferences()
+
+
+    def getConstructionElementsByLabel(self,label):
+
+        return [c for elementType in self.constructionElementsClasses.keys() for c in self.labelIndex.get((elementType,label),[])]
 
 
     def setNetSurface(self,label,surfaceArea):
 
-        paceroot=self.mainTree.getroot()
-        
-        celems=paceroot.findall('.//constructionElements')[0] #findall retuns a list. If one exepects single elem, takes 0 of list
+        for c in self.getConstructionElementsByLabel(label):
+            self.setElementNetSurface(c,surfaceArea)
 
-        for c in celems:
-            #print(c.find('reference').text)
-            
-            if (c.find('reference').text == label):
-                #print(c.find('reference').text)
-                
-                grossSurfaceManually=c.find('netSurfaceManually')
-                state=grossSurfaceManually.find('./INITIAL/CURRENT__STATE')
-                state.text='true'
 
-                grossSurface=c.find('netSurface')
-                state=grossSurface.find('./INITIAL/CURRENT__STATE')
-                state.text=str(surfaceArea)
+    def setElementNetSurface(self,c,surfaceArea):
+
+        grossSurfaceManually=c.find('netSurfaceManually')
+        state=grossSurfaceManually.find('./INITIAL/CURRENT__STATE')
+        state.text='true'
+
+        grossSurface=c.find('netSurface')
+        state=grossSurface.find('./INITIAL/CURRENT__STATE')
+        state.text=str(surfaceArea)
 
 
     def setNetSurfaceMod(self,label,surfaceArea):
 
-        paceroot=self.mainTree.getroot()
-        
-        celems=paceroot.findall('.//constructionElements')[0] #findall retuns a list. If one exepects single elem, takes 0 of list
+        for c in self.getConstructionElementsByLabel(label):
+            self.setElementNetSurfaceMod(c,surfaceArea)
 
-        for c in celems:
-            
-            if (c.find('reference').text == label):
 
-                grossSurface=c.find('netSurface')
-               
-                second = ET.Element("SECOND")
-                grossSurface.append(second)
+    def setElementNetSurfaceMod(self,c,surfaceArea):
 
-                second.set('class', 'com.hemmis.mrw.pace.model.ObservableSpecProperty')
-                second.set('id','99999')
-                second.set('v','2')
-                
-                state = ET.Element("CURRENT__STATE")
-                second.append(state)
-                
-                state.set('class','java.math.BigDecimal')
-                state.text=str(surfaceArea)
+        grossSurface=c.find('netSurface')
+       
+        second = ET.Element("SECOND")
 
-                #manually flag
+        second.set('class', 'com.hemmis.mrw.pace.model.ObservableSpecProperty')
+        second.set('id',self.getNewID())
+        second.set('v','2')
+        
+        state = ET.Element("CURRENT__STATE")
+        second.append(state)
+        
+        state.set('class','java.math.BigDecimal')
+        state.text=str(surfaceArea)
 
-                netSurfaceManually = c.find('netSurfaceManually')
-                
-                second = ET.Element("SECOND")
-                netSurfaceManually.append(second)
+        self.appendElement(grossSurface,second)
 
-                second.set('class', 'com.hemmis.mrw.pace.model.ObservableSpecProperty')
-                second.set('id','99998')
-                second.set('v','2')
-                
-                state = ET.Element("CURRENT__STATE")
-                second.append(state)
-                
-                state.set('class','java.lang.Boolean')
-                state.text='true'
+        #manually flag
 
+        netSurfaceManually = c.find('netSurfaceManually')
+        
+        second = ET.Element("SECOND")
 
+        second.set('class', 'com.hemmis.mrw.pace.model.ObservableSpecProperty')
+        second.set('id',self.getNewID())
+        second.set('v','2')
+        
+        state = ET.Element("CURRENT__STATE")
+        second.append(state)
+        
+        state.set('class','java.lang.Boolean')
+        state.text='true'
 
+        self.appendElement(netSurfaceManually,second)
 
 
     def setGrossSurface(self,label,surfaceArea):
 
-        paceroot=self.mainTree.getroot()
-        
-        celems=paceroot.findall('.//constructionElements')[0] #findall retuns a list. If one exepects single elem, takes 0 of list
+        for c in self.getConstructionElementsByLabel(label):
+            self.setElementGrossSurface(c,surfaceArea)
 
-        for c in celems:
-            #print(c.find('reference').text)
-            
-            if (c.find('reference').text == label):
-                #print(c.find('reference').text)
-                
-                grossSurfaceManually=c.find('grossSurfaceManually')
-                state=grossSurfaceManually.find('./INITIAL/CURRENT__STATE')
-                state.text='true'
 
-                grossSurface=c.find('grossSurface')
-                state=grossSurface.find('./INITIAL/CURRENT__STATE')
-                state.text=str(surfaceArea)
+    def setElementGrossSurface(self,c,surfaceArea):
+
+        grossSurfaceManually=c.find('grossSurfaceManually')
+        state=grossSurfaceManually.find('./INITIAL/CURRENT__STATE')
+        state.text='true'
 
+        grossSurface=c.find('grossSurface')
+        state=grossSurface.find('./INITIAL/CURRENT__STATE')
+        state.text=str(surfaceArea)
 
 
     def setGrossSurfaceMod(self,label,surfaceArea):
 
-        paceroot=self.mainTree.getroot()
-        
-        celems=paceroot.findall('.//constructionElements')[0] #findall retuns a list. If one exepects single elem, takes 0 of list
+        for c in self.getConstructionElementsByLabel(label):
+            self.setElementGrossSurfaceMod(c,surfaceArea)
 
-        for c in celems:
-            
-            if (c.find('reference').text == label):
 
-                grossSurface=c.find('grossSurface')
-               
-                second = ET.Element("SECOND")
-                grossSurface.append(second)
+    def setElementGrossSurfaceMod(self,c,surfaceArea):
 
-                second.set('class', 'com.hemmis.mrw.pace.model.ObservableSpecProperty')
-                second.set('id','999')
-                second.set('v','2')
-                
-                state = ET.Element("CURRENT__STATE")
-                second.append(state)
-                
-                state.set('class','java.math.BigDecimal')
-                state.text=str(surfaceArea)
+        grossSurface=c.find('grossSurface')
+       
+        second = ET.Element("SECOND")
+
+        second.set('class', 'com.hemmis.mrw.pace.model.ObservableSpecProperty')
+        second.set('id',self.getNewID())
+        second.set('v','2')
+        
+        state = ET.Element("CURRENT__STATE")
+        second.append(state)
+        
+        state.set('class','java.math.BigDecimal')
+        state.text=str(surfaceArea)
+
+        self.appendElement(grossSurface,second)
 
 
     def setHeatedVolume(self,initHeatedVolume,modifiedHeatedVolume=None):
@@ -1248,7 +2061,7 @@ class PACEXML:
             
             if (modifiedHeatedVolumeXMLE == None):
                 modifiedHeatedVolumeXMLE = ET.Element("SECOND")
-                heatedVolumeXMLE.append(modifiedHeatedVolumeXMLE)
+                self.appendElement(heatedVolumeXMLE,modifiedHeatedVolumeXMLE)
             
             modifiedHeatedVolumeXMLE.text=str(modifiedHeatedVolume)
             modifiedHeatedVolumeXMLE.attrib['class']='java.math.BigDecimal'
@@ -1258,7 +2071,7 @@ class PACEXML:
         
         levels = self.mainTree.find('.//levels')
         
-        newLevel = ET.Element('com.hemmis.mrw.pace.model.skin.Level',attrib={'id':''})
+        newLevel = ET.Element('com.hemmis.mrw.pace.model.skin.Level',attrib={'id':self.getNewID()})
         ET.SubElement(newLevel,'skin',{'reference':self.mainTree.find('.//skin[@id]').attrib['id']})
 
         subElementsDict = {'shortDescription':levelName,
@@ -1273,7 +2086,7 @@ class PACEXML:
         
         if (situation == 'init'):
             levelsList = levels.find('.//INITIAL')
-            levelsList.append(newLevel)
+            self.appendElement(levelsList,newLevel)
         
         
     def setInertia(self,category,situation='init'):
@@ -1307,8 +2120,8 @@ class PACEXML:
         sunStationElement = ET.Element('weatherStationSun')
         sunStationElement.text = sunStation
         
-        self.mainTree.getroot().append(weatherStationElement)
-        self.mainTree.getroot().append(sunStationElement)
+        self.appendElement(self.mainTree.getroot(),weatherStationElement)
+        self.appendElement(self.mainTree.getroot(),sunStationElement)
         
 
         
@@ -1348,64 +2161,522 @@ class PACEXML:
 
 
 
-    def setPicture(self,imageFile,situation):
-        
-        imagesElement = self.mainTree.find('.//imageInitial')
+    def setPicture(self,imageFile,situation):
+        
+        imagesElement = self.mainTree.find('.//imageInitial')
+
+        
+        if (situation == 'init'):
+            
+            initialImageXMLE = imagesElement.find('.//INITIAL')
+            
+            initialImageXMLE.attrib['class']="java.awt.image.BufferedImage"
+            self.setImageFile(initialImageXMLE,imageFile)
+            
+        elif situation == 'mod':
+            
+            modifiedImageXMLE = imagesElement.find('.//SECOND')
+
+
+            if (modifiedImageXMLE == None):
+                modifiedImageXMLE = ET.Element("SECOND")
+                self.appendElement(imagesElement,modifiedImageXMLE)
+            
+            modifiedImageXMLE.attrib['class']="java.awt.image.BufferedImage"
+            self.setImageFile(modifiedImageXMLE,imageFile)
+                
+        else:
+            return
+    
+    def setFirstPagePicture(self,imageFile):
+        building = self.mainTree.find('.//building[@id]')
+        imageElement = building.find('image')
+        
+        if imageElement is None:
+            imageElement = ET.Element('image',attrib={'class':'java.awt.image.BufferedImage'})
+        
+        self.setImageFile(imageElement,imageFile)
+        
+        self.appendElement(building,imageElement)
+
+
+    def setImageFile(self,element,imageFile):
+        #the element only gets an empty <pacetoolsImage n="..."/> child as a marker: the image is base64 encoded
+        #when the PAE file is written, by chunks, straight into the output (see writeSerialized)
+        #the marker is an element rather than a text, so that no label or description can be taken for it
+        #(a "<" in a text is always escaped)
+
+        os.stat(imageFile) #missing file --> error now rather than when writing
+
+        for marker in element.findall(self.imageTag):
+            self.removeElement(element,marker)
+
+        self.imageFiles.append(os.path.abspath(imageFile))
+        element.text = None
+        self.addSubElement(element,self.imageTag,{'n':str(len(self.imageFiles)-1)})
+
+    def writePaceFile(self,*targets,dumpStats=False):
+        #the file is serialized once and written to every target:
+        #path (compressed if it ends with .gz or .zip), binary file object (e.g. a gzip.GzipFile), or a list of them
+        #dumpStats: stats() is also written next to each path, in <path>.stats.json
+        #
+        #    xml.writePaceFile('audit.xml','audit.pae')
+    
+        #
+        self.finalize()
+
+        data = self.serializeTree()
+
+        targets = [t for target in targets for t in (target if isinstance(target,(list,tuple)) else [target])]
+
+        for target in targets:
+
+            if dumpStats and not hasattr(target,'write'):
+                self.dumpStats(str(target)+'.stats.json')
+
+            if hasattr(target,'write'):
+                self.writeSerialized(target,data)
+
+            elif str(target).endswith('.gz'):
+                import gzip
+                with gzip.open(target,'wb') as f:
+                    self.writeSerialized(f,data)
+
+            elif str(target).endswith('.zip'):
+                #archive with a single file: audit.pae.zip --> audit.pae
+                import zipfile
+                with zipfile.ZipFile(target,'w',zipfile.ZIP_DEFLATED) as archive:
+                    with archive.open(os.path.basename(str(target))[:-len('.zip')],'w') as f:
+                        self.writeSerialized(f,data)
+
+            else:
+                with open(target,'wb') as f:
+                    self.writeSerialized(f,data)
+
+
+    def toBytes(self):
+        #the tree as it is written in PAE files (us-ascii, no xml declaration), without reordering or renumbering it
+
+        buffer = io.BytesIO()
+        self.writeSerialized(buffer,self.serializeTree())
+
+        return buffer.getvalue()
+
+
+    def writeSerialized(self,f,data):
+        #writes the output of serializeTree, with the pictures in place of their markers
+
+        if len(self.imageFiles) == 0:
+            f.write(data)
+            return
+
+        parts = re.split(b'<'+self.imageTag.encode()+rb' n="(\d+)" />',data)
+
+        for k,part in enumerate(parts):
+            if k % 2 == 0:
+                f.write(part)
+            else:
+                imageProcessor().fileToBase64Stream(self.imageFiles[int(part)],f)
+
+
+    def serializeTree(self):
+        #the tree as bytes, with the raw segments (lazy=True) but with markers in place of the pictures
+
+        data = serializeElementTree(self.mainTree)
+
+        if not any(segment.placeholder is not None for segment in self.rawSegments):
+            return data
+
+        #lazy=True: the raw segments are copied in place of their placeholders
+        parts = re.split(b'<'+rawSegment.tag.encode()+rb' n="(\d+)" id="\d+" />',data)
+
+        for k in range(1,len(parts),2):
+            segment = self.rawSegments[int(parts[k])]
+            parts[k] = segment.serialize(int(segment.placeholder.attrib['id']))
+
+        return b''.join(parts)
+
+        """import lxml.etree as etree
+
+        x = etree.parse(filename)
+        xmlstring=etree.tostring(x, pretty_print=True)
+
+        f=open(filename,'wb')
+        f.write(xmlstring)
+        f.close()
+        """
+
+
+
+class profiledElementTree:
+    #main tree of a profiled PACEXML (see PACEXML.enableProfiling): counts the searches started from the root
+    #wraps the ElementTree, everything else is delegated to it
+
+    def __init__(self,tree,counters):
+
+        self.tree = tree
+        self.counters = counters
+
+    def __getattr__(self,name):
+        return getattr(self.tree,name)
+
+    def find(self,*args,**kwargs):
+        self.counters['treeScans'] += 1
+        return self.tree.find(*args,**kwargs)
+
+    def findall(self,*args,**kwargs):
+        self.counters['treeScans'] += 1
+        return self.tree.findall(*args,**kwargs)
+
+    def findtext(self,*args,**kwargs):
+        self.counters['treeScans'] += 1
+        return self.tree.findtext(*args,**kwargs)
+
+    def iterfind(self,*args,**kwargs):
+        self.counters['treeScans'] += 1
+        return self.tree.iterfind(*args,**kwargs)
+
+    def iter(self,*args,**kwargs):
+        self.counters['treeScans'] += 1
+        return self.tree.iter(*args,**kwargs)
+
+
+def cloneElement(element):
+    #copy of an element and its subtree
+    #about twice as fast as copy.deepcopy or parsing the xml again
+
+    Element = ET.Element
+
+    root = Element(element.tag,element.attrib.copy())
+    root.text = element.text
+    root.tail = element.tail
+
+    stack = [(element,root)]
+
+    while len(stack) > 0:
+
+        source,destination = stack.pop()
+
+        for child in source:
+            newChild = Element(child.tag,child.attrib.copy())
+            newChild.text = child.text
+            newChild.tail = child.tail
+            destination.append(newChild)
+
+            if len(child) > 0:
+                stack.append((child,newChild))
+
+    return root
+
+
+class templateCache:
+    
+    #parsed xml templates, shared by all PACEXML instances of the process
+    #keyed by path and modification time: a template modified on disk is parsed again
+    #getElement returns a copy, the cached element itself is never handed out
+
+    def __init__(self,maxSize=None):
+
+        self.maxSize = maxSize #None --> no eviction
+        self.elements = collections.OrderedDict() #path --> (mtime, root element)
+        self.hits = 0
+        self.misses = 0
+
+
+    def getElement(self,fileName):
+
+        path = os.path.abspath(fileName)
+        mtime = os.stat(path).st_mtime_ns
+
+        cached = self.elements.get(path)
+
+        if cached is not None and cached[0] == mtime:
+            self.hits += 1
+            self.elements.move_to_end(path)
+
+        else:
+            self.misses += 1
+            cached = (mtime,ET.parse(path).getroot())
+            self.elements[path] = cached
+            self.elements.move_to_end(path)
+
+            if self.maxSize is not None:
+                while len(self.elements) > self.maxSize:
+                    self.elements.popitem(last=False)
+
+        return cloneElement(cached[1])
+
+
+    def clear(self):
+
+        self.elements.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+    def stats(self):
+
+        return {'hits':self.hits,'misses':self.misses,'size':len(self.elements),'maxSize':self.maxSize}
+
+
+templatesCache = templateCache()
+
+
+def serializeElementTree(tree):
+    #tree as ElementTree writes it: us-ascii (character references), no xml declaration, empty elements as <tag />
+
+    buffer = io.BytesIO()
+    tree.write(buffer)
+
+    return buffer.getvalue()
+
+
+def normalizeEmptyElements(data):
+    #<tag></tag> and <tag/> --> <tag />, as written by ElementTree
+
+    data = re.sub(rb'<([^\s<>/!?]+)((?:\s[^<>]*?)?)></\1>',rb'<\1\2/>',data)
+
+    return re.sub(rb'(?<! )/>',b' />',data)
+
+
+def findElementBytes(data,tag):
+    #(start,end) offsets of the first non empty <tag> element of an xml document, found by a plain byte search
+    #(elements with an empty tag, e.g. <tag reference="12"/>, are skipped)
+    #assumes no comments, CDATA sections or ">" in attribute values, which is the case of PACE files
+
+    opening = b'<'+tag.encode()
+    closing = b'</'+tag.encode()+b'>'
+
+    def nextOpening(position):
+        #next start tag of the element, not of another one whose name starts with tag
+        while True:
+            start = data.find(opening,position)
+            if start < 0 or data[start+len(opening):start+len(opening)+1] in (b' ',b'>',b'/',b'\t',b'\r',b'\n'):
+                return start
+            position = start+1
+
+    def isEmptyTag(start):
+        return data[data.find(b'>',start)-1:data.find(b'>',start)] == b'/'
+
+    start = nextOpening(0)
+    while start >= 0 and isEmptyTag(start):
+        start = nextOpening(start+1)
+
+    if start < 0:
+        return None
+
+    depth = 0
+    position = start
+
+    while True:
+
+        nextStart = nextOpening(position)
+        nextEnd = data.find(closing,position)
+
+        if nextEnd < 0:
+            return None
+
+        if 0 <= nextStart < nextEnd:
+            if not isEmptyTag(nextStart):
+                depth += 1
+            position = data.find(b'>',nextStart)+1
+
+        else:
+            depth -= 1
+            position = nextEnd+len(closing)
+
+            if depth == 0:
+                return start,position
+
+
+class rawSegment:
+
+    #section of a template file that is kept as bytes instead of being parsed (PACEXML(...,lazy=True))
+    #in the tree, it is replaced by an empty <pacetoolsRawSegment n="..." id="..."/> element which stands for the
+    #count ids of the section: firstID...firstID+count-1 in the file, id...id+count-1 in the tree
+
+    tag = 'pacetoolsRawSegment'
+
+    def __init__(self,path,start,end,parentTag,firstID,count,externalReferences):
+
+        self.path = path
+        self.start = start
+        self.end = end
+        self.parentTag = parentTag
+        self.firstID = firstID
+        self.count = count
+        self.placeholder = None #None once the segment has been parsed (see PACEXML.materializeSegment)
+
+        stat = os.stat(path)
+        self.fileStamp = (stat.st_size,stat.st_mtime_ns)
+
+        #references to ids defined outside of the segment
+        #they are registered in the index of the main tree, so they are renumbered like any other reference
+        self.proxies = {ref:ET.Element('reference',{'reference':ref}) for ref in externalReferences}
+
+        #serialized bytes (see serialize), shared with the copies of the segment (see PACEXML.copy)
+        self.cache = {}
+
+
+    def checkFile(self):
+
+        stat = os.stat(self.path)
+
+        if (stat.st_size,stat.st_mtime_ns) != self.fileStamp:
+            raise ValueError(self.path+" has been modified since it was opened with lazy=True")
+
+
+    def read(self):
+
+        self.checkFile()
+
+        with open(self.path,'rb') as f:
+            f.seek(self.start)
+            return f.read(self.end-self.start)
+
+
+    def remapIDs(self,data,newFirstID):
+        #bytes of the segment with the ids and references of the tree
+
+        lastID = self.firstID+self.count-1
+        shift = newFirstID-self.firstID
+
+        def remap(match):
+            oldID = match.group(2).decode()
+            if self.firstID <= int(oldID) <= lastID:
+                newID = str(int(oldID)+shift)
+            elif oldID in self.proxies:
+                newID = self.proxies[oldID].attrib['reference']
+            else:
+                return match.group(0)
+            return match.group(1)+b'="'+newID.encode()+b'"'
+
+        return re.sub(rb'( id| reference)="(\d+)"',remap,data)
+
+
+    def serialize(self,newFirstID):
+        #segment as ElementTree writes it: us-ascii, empty elements as <tag />
+        #the normalized bytes and the last remapping are cached: the variants of an audit usually remap them the same way
+
+        self.checkFile()
+
+        key = (newFirstID,tuple(proxy.attrib['reference'] for proxy in self.proxies.values()))
+
+        if self.cache.get('key') != key:
+            if 'normalized' not in self.cache:
+                self.cache['normalized'] = normalizeEmptyElements(self.read().decode('utf-8').encode('ascii','xmlcharrefreplace'))
+            self.cache['remapped'] = self.remapIDs(self.cache['normalized'],newFirstID)
+            self.cache['key'] = key
+
+        return self.cache['remapped']
+
+
+class constructionElementsLibrary:
+
+    #index of a construction elements database (e.g. constructionElementsDataBase.xml):
+    #(elementType, shortDescription) --> serialized element, saved next to the database in <database>.index.json
+    #and rebuilt only when the database changes, so listing the library or loading one element does not parse it
+
+    libraries = {} #path --> library, see shared()
+
+    def __init__(self,fileName,constructionElementsClasses):
+
+        self.path = os.path.abspath(fileName)
+        self.indexFile = self.path+'.index.json'
+        self.constructionElementsClasses = constructionElementsClasses
+
+        stat = os.stat(self.path)
+        self.fileStamp = [stat.st_size,stat.st_mtime_ns]
+
+        self.elements = self.readIndex()
+
+        if self.elements is None:
+            self.elements = self.buildIndex()
+            self.writeIndex()
+
+
+    @classmethod
+    def shared(cls,fileName,constructionElementsClasses):
+        #library of the file, indexed only once per process (again if the file has been modified)
+
+        path = os.path.abspath(fileName)
+        library = cls.libraries.get(path)
+
+        stat = os.stat(path)
+        if library is None or library.fileStamp != [stat.st_size,stat.st_mtime_ns]:
+            library = cls(path,constructionElementsClasses)
+            cls.libraries[path] = library
+
+        return library
+
+
+    def readIndex(self):
+
+        import json
+
+        try:
+            with open(self.indexFile,encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError,ValueError):
+            return None
+
+        if index.get('source') != os.path.basename(self.path) or index.get('fileStamp') != self.fileStamp:
+            return None
+
+        return index['elements']
+
 
-        asciiImage = imageProcessor().fileToBase64(imageFile)
+    def writeIndex(self):
 
-        
-        if (situation == 'init'):
-            
-            initialImageXMLE = imagesElement.find('.//INITIAL')
-            
-            initialImageXMLE.attrib['class']="java.awt.image.BufferedImage"
-            initialImageXMLE.text = asciiImage
-            
-        elif situation == 'mod':
-            
-            modifiedImageXMLE = imagesElement.find('.//SECOND')
+        import json
 
+        try:
+            with open(self.indexFile,'w',encoding='utf-8') as f:
+                json.dump({'source':os.path.basename(self.path),'fileStamp':self.fileStamp,'elements':self.elements},f)
+        except OSError:
+            print("could not write the library index",self.indexFile,"(the database will be parsed again next time)")
 
-            if (modifiedImageXMLE == None):
-                modifiedImageXMLE = ET.Element("SECOND")
-                imagesElement.append(modifiedImageXMLE)
-            
-            modifiedImageXMLE.attrib['class']="java.awt.image.BufferedImage"
-            modifiedImageXMLE.text = asciiImage
-                
-        else:
-            return
-    
-    def setFirstPagePicture(self,imageFile):
-        building = self.mainTree.find('.//building[@id]')
-        imageElement = building.find('image')
-        
-        if imageElement is None:
-            imageElement = ET.Element('image',attrib={'class':'java.awt.image.BufferedImage'})
-        
-        asciiImage = imageProcessor().fileToBase64(imageFile)
 
-        imageElement.text = asciiImage
-        
-        building.append(imageElement)
+    def buildIndex(self):
+        #same elements as PACEXML.getConstructionElements on the database: the last one wins for a duplicate description
 
-    def writePaceFile(self,filename):
-    
-        #
-        self.renumberTreeOrElem(self.mainTree,1) 
-        self.mainTree.write(filename)
+        templateElems = ET.parse(self.path).find('.//constructionElements[@id]')
 
-        """import lxml.etree as etree
+        elements = {}
 
-        x = etree.parse(filename)
-        xmlstring=etree.tostring(x, pretty_print=True)
+        for elementType in ['wall','floor','roof','transparentElement']:
 
-        f=open(filename,'wb')
-        f.write(xmlstring)
-        f.close()
-        """
+            paceClass = self.constructionElementsClasses[elementType]
+
+            elementsOfClass = templateElems.findall('.//'+paceClass+'[@id]') + templateElems.findall('.//*[@class="'+paceClass+'"][@id]')
+
+            elemsDict = {}
+
+            for elem in elementsOfClass:
+                tail = elem.tail
+                elem.tail = None
+                elemsDict[elem.find('.//shortDescription').text] = {'xml':ET.tostring(elem,encoding='unicode'),'tail':tail}
+                elem.tail = tail
 
+            elements[elementType] = elemsDict
+
+        return elements
+
+
+    def getDescriptions(self):
+
+        return {elementType:list(elemsDict.keys()) for elementType,elemsDict in self.elements.items()}
+
+
+    def getElement(self,elementType,description):
+        #new element, parsed from the index
+
+        serialized = self.elements[elementType][description]
+
+        element = ET.fromstring(serialized['xml'])
+        element.tail = serialized['tail']
+
+        return element
 
 
 class imageProcessor:
@@ -1420,9 +2691,25 @@ class imageProcessor:
             base64_message = base64_encoded_data.decode('utf-8')
 
         return base64_message
+
+
+    def fileToBase64Stream(self,imFile,f,chunkSize=3*65536):
+        #same as fileToBase64, written into f by chunks (a multiple of 3 bytes, so that they encode independently)
+
+        import base64
+
+        with open(imFile, 'rb') as binary_file:
+            while True:
+                chunk = binary_file.read(chunkSize)
+                if len(chunk) == 0:
+                    break
+                f.write(base64.b64encode(chunk))
     
     
 class materials:
+
+    #catalogs read by shared(), one per file and modification time, common to all PACEXML instances
+    catalogs = {}
     
     def __init__(self):
         
@@ -1433,6 +2720,30 @@ class materials:
                         }
     
         self.Nmaterials = 0
+
+        #indexes built by read: (category, material) --> material id, category --> category id, category --> materials
+        self.materialIDs = {}
+        self.categoryIDs = {}
+        self.categoryMaterials = {}
+
+
+    @classmethod
+    def shared(cls,fileName):
+        #catalog of the file, read only once per process (read again if the file has been modified)
+
+        path = os.path.abspath(fileName)
+        mtime = os.stat(path).st_mtime_ns
+
+        cached = cls.catalogs.get(path)
+
+        if cached is None or cached[0] != mtime:
+            catalog = cls()
+            catalog.read(path)
+            cached = (mtime,catalog)
+            cls.catalogs[path] = cached
+
+        return cached[1]
+
     
     def read(self,fileName):
         
@@ -1448,28 +2759,37 @@ class materials:
         for c,key in zip(range(ncols),self.materials.keys()) :
             self.materials[key] = a[:,c]
 
+        self.materialIDs = {}
+        self.categoryIDs = {}
+        self.categoryMaterials = {}
+
+        for materialID,materialName,categoryName,categoryID in zip(*[self.materials[key].tolist() for key in self.materials.keys()]):
+            self.materialIDs.setdefault((categoryName,materialName),materialID) #first one, as the masks did
+            self.categoryIDs.setdefault(categoryName,categoryID)
+            self.categoryMaterials.setdefault(categoryName,[]).append(materialName)
+
 
     def getMaterialsInCategory(self,categoryName):
 
-        return list(self.materials['materialName'][self.materials['materialCategory'] == categoryName ])
+        return list(self.categoryMaterials.get(categoryName,[]))
 
     
     def getCategoryID(self,categoryName):
 
+        if categoryName not in self.categoryIDs:
+            raise ValueError("Unknown material category '"+str(categoryName)+"', known categories: "+', '.join(self.categoryIDs.keys()))
         
-        return self.materials['materialCategoryID'][self.materials['materialCategory'] == categoryName ] [0]
+        return self.categoryIDs[categoryName]
         
     
     def getMaterialAndCategoryID(self,materialName,categoryName):
         
         catID = self.getCategoryID(categoryName)
+
+        if (categoryName,materialName) not in self.materialIDs:
+            raise ValueError("Unknown material '"+str(materialName)+"' in category '"+str(categoryName)+"'")
         
-        condition1 = np.array(self.materials['materialCategory'] == categoryName)
-        condition2 = np.array(self.materials['materialName'] == materialName)
-        
-        globalCondition = condition1*condition2
-        
-        matID = self.materials['materialID'][ globalCondition ][0]
+        matID = self.materialIDs[(categoryName,materialName)]
 
 
         return matID,catID
@@ -1478,6 +2798,691 @@ class materials:
                     
 
     
+def floatOrNan(text):
+
+    try:
+        return float(text)
+    except (TypeError,ValueError):
+        return np.nan
+
+
+#class --> elementType, the reverse of PACEXML.constructionElementsClasses (same as PACEXML.constructionElementsTypes)
+classToElementType = {'com.hemmis.mrw.pace.model.skin.Wall':'wall',
+                      'com.hemmis.mrw.pace.model.skin.Roof':'roof',
+                      'com.hemmis.mrw.pace.model.skin.Floor':'floor',
+                      'com.hemmis.mrw.pace.model.skin.TransparentElement':'transparentElement'}
+
+
+def readPaceFile(fileName):
+    #fields of an existing PAE file, read in one streaming pass (iterparse): the elements are dropped as soon as
+    #they have been read, so memory does not grow with the size of the file
+    #returns numpy columns:
+    #  'heatedVolume': [INITIAL, SECOND]
+    #  'constructionElements': id, type, label, description, environment, grossSurfaceInitial, grossSurfaceSecond,
+    #                          netSurfaceInitial, netSurfaceSecond, layers (number of)
+    #  'openings': name, opaqueElement, transparentElement (labels), surfaceInitial, surfaceSecond, orientation
+    #  'layers': constructionElement (label), materialID, materialGroupID, thickness, lambda
+    #missing numbers are nan, missing texts ''
+
+    def className(e):
+        return e.attrib.get('class',e.tag)
+
+    propertyValues = {} #id of an ObservableSpecProperty --> value, for the properties used through a reference
+
+    def situationValue(e,situation):
+        #value of a situation property (grossSurface, surface...) for INITIAL or SECOND
+        s = e.find(situation) if e is not None else None
+        if s is None:
+            return np.nan
+        if 'reference' in s.attrib:
+            return floatOrNan(propertyValues.get(s.attrib['reference']))
+        if len(s) > 0:
+            return floatOrNan(s.findtext('CURRENT__STATE'))
+        return floatOrNan(s.text)
+
+    def objectKey(e):
+        #how an element designates an object: reference to its id, its label (uniqueReference) or its definition
+        if e is None:
+            return None
+        if 'uniqueReference' in e.attrib:
+            return ('label',e.attrib['uniqueReference'])
+        return ('id',e.attrib.get('reference',e.attrib.get('id')))
+
+    elements = []
+    openings = []
+    layers = []
+    heatedVolume = [np.nan,np.nan]
+    opaqueStructures = {} #id of an opaqueStructure --> id of its construction element
+
+    #XStream nests the definitions (a wall defines its openings, which define their windows, which define other walls...),
+    #so an object cannot be kept until its end: its fields (direct children) are read at their own end and dropped,
+    #only the two first levels under a field are kept until then
+    records = {} #open object --> fields read so far
+    stack = [] #open elements: [element, depth under the nearest field (None outside of the fields), is an object]
+
+    def isObject(e):
+        c = className(e)
+        return 'id' in e.attrib and (c in classToElementType or c.endswith('.skin.Opening') or c.endswith('.skin.Layer')) or e.tag == 'basicHeatedSpace'
+
+    def readField(record,e):
+        if e.tag in ('grossSurface','netSurface','surface'):
+            record[e.tag] = (situationValue(e,'INITIAL'),situationValue(e,'SECOND'))
+        elif e.tag in ('opaqueElement','transparentElement'):
+            record[e.tag] = (objectKey(e.find('INITIAL')),objectKey(e.find('SECOND')))
+        elif e.tag == 'opaqueStructure':
+            record[e.tag] = objectKey(e)
+        elif e.tag == 'orientation':
+            record[e.tag] = (e.findtext('INITIAL'),e.findtext('SECOND'))
+        elif e.tag == 'material':
+            record[e.tag] = (e.findtext('id',''),e.findtext('materialGroupId',''))
+        elif len(e) == 0:
+            record[e.tag] = e.text
+
+    def situationField(record,name):
+        #INITIAL value of a field, or the SECOND one for the openings that only exist in the modified situation
+        #(state ADDED, see addOpeningNetMethodMod) or that have no INITIAL value
+        initial,second = record.get(name,(None,None))
+        if second is not None and (initial is None or record.get('state') == 'ADDED'):
+            return second
+        return initial
+
+    def owner():
+        #construction element an element is defined in
+        return next((s[0].attrib['id'] for s in reversed(stack) if s[2] and className(s[0]) in classToElementType),None)
+
+    for event,e in ET.iterparse(fileName,events=('start','end')):
+
+        if event == 'start':
+            if len(stack) == 0:
+                depth = None
+            elif stack[-1][2]:
+                depth = 0
+            elif stack[-1][1] is not None:
+                depth = stack[-1][1]+1
+            else:
+                depth = None
+            stack.append([e,depth,isObject(e)])
+            if stack[-1][2]:
+                records[e] = {}
+            continue
+
+        e,depth,isObj = stack.pop()
+        parent = stack[-1][0] if len(stack) > 0 else None
+
+        if e.tag == 'CURRENT__STATE' and parent is not None and parent.attrib.get('class') == 'com.hemmis.mrw.pace.model.ObservableSpecProperty' and 'id' in parent.attrib:
+            propertyValues[parent.attrib['id']] = e.text
+
+        if e.tag == 'opaqueStructure' and 'id' in e.attrib:
+            opaqueStructures[e.attrib['id']] = owner()
+
+        if isObj:
+
+            record = records.pop(e)
+            c = className(e)
+
+            if c in classToElementType:
+                elements.append([e.attrib['id'],classToElementType[c],record.get('reference') or '',record.get('shortDescription') or '',record.get('environment') or '']
+                                +list(record.get('grossSurface',(np.nan,np.nan)))+list(record.get('netSurface',(np.nan,np.nan))))
+
+            elif c.endswith('.skin.Opening'):
+                openings.append([record.get('shortDescription') or '',situationField(record,'opaqueElement'),situationField(record,'transparentElement')]
+                                +list(record.get('surface',(np.nan,np.nan)))+[situationField(record,'orientation') or ''])
+
+            elif c.endswith('.skin.Layer'):
+                #a layer belongs to the construction element it is defined in, or else to the one of its opaqueStructure
+                material = record.get('material',('',''))
+                layers.append([owner(),record.get('opaqueStructure'),material[0],material[1],floatOrNan(record.get('thickness')),floatOrNan(record.get('lamda'))])
+
+            else:
+                heatedVolume = [floatOrNan(record.get('INITIAL')),floatOrNan(record.get('SECOND'))]
+
+        if depth == 0:
+            readField(records[parent],e)
+
+        #kept: the two first levels under a field, and the objects (for their id) until their parent is dropped
+        if depth is None or depth == 0 or depth > 2:
+            e.clear()
+            if parent is not None:
+                parent.remove(e)
+
+    labels = {elem[0]:elem[2] for elem in elements}
+
+    def label(key):
+        if key is None:
+            return ''
+        if key[0] == 'label':
+            return key[1]
+        return labels.get(key[1],'')
+
+    for layer in layers:
+        if layer[0] is None and layer[1] is not None:
+            layer[0] = opaqueStructures.get(layer[1][1])
+    layersCount = collections.Counter(layer[0] for layer in layers)
+
+    def columns(names,rows,types):
+        return {name:np.array([row[k] for row in rows],dtype=t) for k,(name,t) in enumerate(zip(names,types))}
+
+    return {'file':fileName,
+            'heatedVolume':np.array(heatedVolume),
+            'constructionElements':dict(columns(['id','type','label','description','environment','grossSurfaceInitial','grossSurfaceSecond','netSurfaceInitial','netSurfaceSecond'],
+                                                elements,[str]*5+[float]*4),
+                                        layers=np.array([layersCount[elem[0]] for elem in elements],dtype=int)),
+            'openings':columns(['name','opaqueElement','transparentElement','surfaceInitial','surfaceSecond','orientation'],
+                               [[o[0],label(o[1]),label(o[2]),o[3],o[4],o[5]] for o in openings],[str,str,str,float,float,str]),
+            'layers':columns(['constructionElement','materialID','materialGroupID','thickness','lambda'],
+                             [[labels.get(layer[0],''),layer[2],layer[3],layer[4],layer[5]] for layer in layers],[str,str,str,float,float])}
+
+
+def readPaceFileSafely(fileName):
+
+    try:
+        return readPaceFile(fileName)
+    except Exception as e:
+        return {'file':fileName,'error':type(e).__name__+': '+str(e)}
+
+
+def scanPaceFiles(directory,workers=None,extension='.pae'):
+    #readPaceFile on every file of the directory tree, in a pool of worker processes (workers=1 --> in this process)
+    #files that cannot be read give {'file':..., 'error':...}; see also concatenateScans
+
+    fileNames = sorted(os.path.join(root,name) for root,dirs,names in os.walk(directory) for name in names if name.endswith(extension))
+
+    if workers == 1:
+        return [readPaceFileSafely(f) for f in fileNames]
+
+    import multiprocessing
+
+    with multiprocessing.Pool(workers) as pool:
+        return pool.map(readPaceFileSafely,fileNames,chunksize=4)
+
+
+def concatenateScans(results,section):
+    #one table for a whole portfolio: the columns of section ('constructionElements', 'openings' or 'layers')
+    #of every file, plus a 'file' column
+
+    results = [r for r in results if 'error' not in r]
+
+    if len(results) == 0:
+        return {}
+
+    table = {name:np.concatenate([r[section][name] for r in results]) for name in results[0][section].keys()}
+    table['file'] = np.concatenate([np.full(len(next(iter(r[section].values()))),r['file']) for r in results])
+
+    return table
+
+
+def validateTree(root,rawSegments=()):
+    #referential integrity of a PACE tree, in one pass in document order (XStream resolves a reference with the
+    #ids read so far, so a reference must come after the definition it designates)
+    #returns a list of diagnostics, dicts with:
+    #  'severity': 'error' or 'warning'
+    #  'kind': 'duplicateID', 'forwardReference', 'danglingReference', 'duplicateInitial' or 'duplicateSecond' (a
+    #          situation property with two INITIAL or two SECOND), 'missingInitial' (SECOND without INITIAL: a warning,
+    #          it is what addOpeningNetMethodMod writes for an opening that only exists in the second situation)
+    #  'id': id or reference concerned (id of the property for the situations), 'tag': tag of the element,
+    #  'owner': id of the nearest ancestor that has one
+    #the placeholders of PACEXML(...,lazy=True) stand for the ids of their raw segment
+
+    diagnostics = []
+    defined = set()
+    pending = {} #reference to an id not defined yet --> [(tag, owner)]
+
+    def report(severity,kind,elemID,tag,owner):
+        diagnostics.append({'severity':severity,'kind':kind,'id':elemID,'tag':tag,'owner':owner})
+
+    def define(elemID,tag,owner):
+        if elemID in defined:
+            report('error','duplicateID',elemID,tag,owner)
+            return
+        defined.add(elemID)
+        for refTag,refOwner in pending.pop(elemID,[]):
+            report('error','forwardReference',elemID,refTag,refOwner)
+
+    def refer(elemID,tag,owner):
+        if elemID not in defined:
+            pending.setdefault(elemID,[]).append((tag,owner))
+
+    stack = [(root,None)]
+
+    while len(stack) > 0:
+
+        e,owner = stack.pop()
+
+        if e.tag == rawSegment.tag and len(rawSegments) > 0:
+            segment = rawSegments[int(e.attrib['n'])]
+            firstID = int(e.attrib['id'])
+            for proxy in segment.proxies.values():
+                refer(proxy.attrib['reference'],e.tag,owner)
+            for elemID in range(firstID,firstID+segment.count):
+                define(str(elemID),e.tag,owner)
+            continue
+
+        if 'id' in e.attrib:
+            define(e.attrib['id'],e.tag,owner)
+        if 'reference' in e.attrib:
+            refer(e.attrib['reference'],e.tag,owner)
+
+        situations = collections.Counter(child.tag for child in e if child.tag in ('INITIAL','SECOND'))
+        for situation,count in situations.items():
+            if count > 1:
+                report('error','duplicate'+situation.capitalize(),e.attrib.get('id'),e.tag,owner)
+        if situations['SECOND'] > 0 and situations['INITIAL'] == 0:
+            report('warning','missingInitial',e.attrib.get('id'),e.tag,owner)
+
+        childOwner = e.attrib.get('id',owner)
+        stack.extend((child,childOwner) for child in reversed(e))
+
+    for elemID,references in pending.items():
+        for tag,owner in references:
+            report('error','danglingReference',elemID,tag,owner)
+
+    return diagnostics
+
+
+def validateFile(fileName):
+    #validateTree on a PAE file, {'file':..., 'diagnostics':[...]} (or 'error' if it cannot be parsed)
+
+    try:
+        return {'file':fileName,'diagnostics':validateTree(ET.parse(fileName).getroot())}
+    except Exception as e:
+        return {'file':fileName,'error':type(e).__name__+': '+str(e)}
+
+
+def validateMain(argv):
+    #python pacetools.py validate file.pae directory ... --workers N
+
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(prog='pacetools.py validate',description='checks the ids and references of PAE files')
+    parser.add_argument('paths',nargs='+',help='PAE files, or directories searched for .pae files')
+    parser.add_argument('--workers',type=int,default=None,help='number of worker processes (default: one per cpu)')
+    parser.add_argument('--warnings',action='store_true',help='also print the warnings')
+    parser.add_argument('--json',action='store_true',help='prints the diagnostics as json lines, one per file')
+    args = parser.parse_args(argv)
+
+    fileNames = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            fileNames += sorted(os.path.join(root,name) for root,dirs,names in os.walk(path) for name in names if name.endswith('.pae'))
+        else:
+            fileNames.append(path)
+
+    def report(results):
+        #prints the results as they come, returns the number of invalid files
+
+        invalid = 0
+
+        for result in results:
+
+            errors = [d for d in result.get('diagnostics',[]) if d['severity'] == 'error']
+            if len(errors) > 0 or 'error' in result:
+                invalid += 1
+
+            if args.json:
+                print(json.dumps(result))
+            elif 'error' in result:
+                print(result['file'],'FAILED:',result['error'])
+            else:
+                shown = result['diagnostics'] if args.warnings else errors
+                print(result['file'],'%d errors, %d warnings' % (len(errors),len(result['diagnostics'])-len(errors)))
+                for d in shown:
+                    print('  %s %s: <%s> id %s, in %s' % (d['severity'],d['kind'],d['tag'],d['id'],d['owner']))
+
+        return invalid
+
+    if args.workers == 1:
+        invalid = report(map(validateFile,fileNames))
+    else:
+        import multiprocessing
+        with multiprocessing.Pool(args.workers) as pool:
+            invalid = report(pool.imap(validateFile,fileNames,chunksize=4))
+
+    print(len(fileNames)-invalid,'of',len(fileNames),'files valid')
+
+    return 1 if invalid > 0 else 0
+
+
+variantBase = None #base audit of the variants in this process (see PACEXML.variants)
+
+
+def initVariantWorker(base):
+
+    global variantBase
+    variantBase = base
+
+
+def runVariant(task):
+    #builds and writes one variant, returns (index, output file, duration in s, error message or None)
+
+    k,params,output = task
+    start = time.perf_counter()
+
+    try:
+
+        xml = variantBase.copy()
+
+        for method,value in params.items():
+            if method.startswith('_') or not callable(getattr(PACEXML,method,None)):
+                raise ValueError("unknown PACEXML method "+method)
+            if isinstance(value,tuple):
+                getattr(xml,method)(*value)
+            elif isinstance(value,dict):
+                getattr(xml,method)(**value)
+            else:
+                getattr(xml,method)(value)
+
+        xml.writePaceFile(output)
+
+    except Exception as e:
+        return k,output,time.perf_counter()-start,type(e).__name__+': '+str(e)
+
+    return k,output,time.perf_counter()-start,None
+
+
+def readJobs(manifestFile):
+    #job manifest: one json object per line, e.g.
+    #
+    #{"template": "paceTemplates/audit_vierge.xml", "output": "out/audit1.pae", "templatesDir": "paceTemplates",
+    # "steps": [{"method": "setMeasurementMethod", "args": ["surfacesnettes"]},
+    #           {"method": "addConstructionElement", "args": ["wall","M1","mur 1","OPEN_AIR","FULL"]},
+    #           {"method": "setNetSurface", "args": ["M1",50]},
+    #           {"method": "addOpeningNetMethod", "args": ["Ouverture 1","F1","N"], "kwargs": {"area": 1.2}}]}
+    #
+    #steps are PACEXML method calls, run in order; optional keys: "deferFinalize" (default false)
+
+    import json
+
+    jobs = []
+
+    with open(manifestFile,encoding='utf-8') as f:
+        for line in f:
+            if line.strip() != '':
+                jobs.append(json.loads(line))
+
+    return jobs
+
+
+def runJob(job):
+    #builds and writes one audit, returns (output file, duration in s, error message or None)
+    #the base template is taken from templatesCache, so a worker parses it only once
+
+    start = time.perf_counter()
+
+    try:
+
+        xml = PACEXML.fromCachedTemplate(job['template'],job.get('deferFinalize',False))
+
+        if 'templatesDir' in job:
+            xml.setTemplatesDir(job['templatesDir'])
+
+        for step in job.get('steps',[]):
+            if step['method'].startswith('_') or not callable(getattr(PACEXML,step['method'],None)):
+                raise ValueError("unknown PACEXML method "+step['method'])
+            getattr(xml,step['method'])(*step.get('args',[]),**step.get('kwargs',{}))
+
+        xml.writePaceFile(job['output'])
+
+    except Exception as e:
+        return job.get('output'),time.perf_counter()-start,type(e).__name__+': '+str(e)
+
+    return job['output'],time.perf_counter()-start,None
+
+
+def runJobs(jobs,workers=None):
+    #runs the jobs in a pool of worker processes (workers=None --> one per cpu, 1 --> in this process)
+    #yields (job index, output file, duration, error) as the jobs complete
+
+    if workers == 1:
+        for k,job in enumerate(jobs):
+            yield (k,)+runJob(job)
+        return
+
+    import multiprocessing
+
+    with multiprocessing.Pool(workers) as pool:
+        for k,result in pool.imap_unordered(indexedJob,list(enumerate(jobs))):
+            yield (k,)+result
+
+
+def indexedJob(indexAndJob):
+
+    return indexAndJob[0],runJob(indexAndJob[1])
+
+
+def batchMain(argv):
+    #python pacetools.py batch jobs.jsonl --workers N
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='pacetools.py batch',description='writes the PAE files of a job manifest')
+    parser.add_argument('manifest',help='json lines file, one job per line (see readJobs)')
+    parser.add_argument('--workers',type=int,default=None,help='number of worker processes (default: one per cpu)')
+    args = parser.parse_args(argv)
+
+    jobs = readJobs(args.manifest)
+
+    start = time.perf_counter()
+    failures = 0
+
+    for k,output,duration,error in runJobs(jobs,args.workers):
+        if error is None:
+            print('job',k,output,'%.2f s' % duration)
+        else:
+            failures += 1
+            print('job',k,output,'FAILED after %.2f s:' % duration,error)
+
+    print(len(jobs)-failures,'of',len(jobs),'jobs written in %.2f s' % (time.perf_counter()-start))
+
+    return 1 if failures > 0 else 0
+
+
+def warmUp(templates=(),templatesDir=None):
+    #loads what the jobs use into the caches of this process: base templates and sub-templates (templatesCache),
+    #materials catalog and construction elements library
+
+    for template in templates:
+        templatesCache.getElement(template)
+
+    if templatesDir is None:
+        return
+
+    for name in sorted(os.listdir(templatesDir)):
+        if name.endswith('_xml.xml'):
+            templatesCache.getElement(os.path.join(templatesDir,name))
+
+    if os.path.exists(os.path.join(templatesDir,'materials.csv')):
+        materials.shared(os.path.join(templatesDir,'materials.csv'))
+
+    if os.path.exists(os.path.join(templatesDir,'constructionElementsDataBase.xml')):
+        constructionElementsLibrary.shared(os.path.join(templatesDir,'constructionElementsDataBase.xml'),
+                                           {elementType:c for c,elementType in classToElementType.items()})
+
+
+async def serveConnection(reader,writer,executor,stop):
+    #json lines protocol: one job per line (see readJobs, plus an optional "id" echoed in the answer), answered with
+    #{"id":..., "output":..., "duration":..., "error":...} as soon as it is written, so answers can come out of order
+    #{"command": "ping"} is answered with {"id":..., "ping": "pong"}, {"command": "stop"} stops the daemon
+
+    import asyncio
+    import json
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def answer(message):
+        writer.write((json.dumps(message)+'\n').encode())
+        await writer.drain()
+
+    async def build(job):
+        output,duration,error = await loop.run_in_executor(executor,runJob,job)
+        await answer({'id':job.get('id'),'output':output,'duration':duration,'error':error})
+
+    while True:
+
+        line = await reader.readline()
+        if len(line) == 0:
+            break
+        if line.strip() == b'':
+            continue
+
+        try:
+            request = json.loads(line)
+            if not isinstance(request,dict):
+                raise ValueError('a request must be a json object')
+        except ValueError as e:
+            await answer({'id':None,'error':type(e).__name__+': '+str(e)})
+            continue
+
+        command = request.get('command')
+
+        if command == 'ping':
+            await answer({'id':request.get('id'),'ping':'pong'})
+        elif command == 'stop':
+            await answer({'id':request.get('id'),'stop':True})
+            stop.set()
+        elif command is not None:
+            await answer({'id':request.get('id'),'error':'unknown command '+str(command)})
+        else:
+            task = asyncio.ensure_future(build(request))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    if len(tasks) > 0:
+        await asyncio.wait(tasks)
+
+    writer.close()
+
+
+async def serve(socketPath=None,host='127.0.0.1',port=8765,workers=None,templates=(),templatesDir='paceTemplates'):
+    #daemon that builds audits from jobs sent on a unix socket (socketPath) or on host:port, see serveConnection
+    #the worker processes are started and warmed up once (see warmUp), so a job costs only its own build
+
+    import asyncio
+    import concurrent.futures
+
+    if workers == 1:
+        warmUp(templates,templatesDir)
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(workers,initializer=warmUp,initargs=(templates,templatesDir))
+        #starts and warms up the workers now rather than on the first jobs
+        list(executor.map(len,[[]]*(workers or os.cpu_count() or 1)))
+
+    stop = asyncio.Event()
+
+    def connected(reader,writer):
+        return serveConnection(reader,writer,executor,stop)
+
+    if socketPath is not None:
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        server = await asyncio.start_unix_server(connected,path=socketPath)
+    else:
+        server = await asyncio.start_server(connected,host,port)
+
+    print('pacetools daemon listening on',socketPath if socketPath is not None else '%s:%d' % (host,port),flush=True)
+
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        executor.shutdown()
+        if socketPath is not None and os.path.exists(socketPath):
+            os.remove(socketPath)
+
+
+def submitJob(job,socketPath=None,host='127.0.0.1',port=8765,timeout=None):
+    #client side of serve: sends one job (or command) and waits for its answer
+    #
+    #    answer = submitJob({'template':..., 'output':..., 'steps':[...]},socketPath='/tmp/pacetools.sock')
+
+    import json
+    import socket
+
+    if socketPath is not None:
+        connection = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        connection.connect(socketPath)
+    else:
+        connection = socket.create_connection((host,port),timeout=timeout)
+
+    with connection, connection.makefile('rwb') as f:
+        f.write((json.dumps(job)+'\n').encode())
+        f.flush()
+        connection.shutdown(socket.SHUT_WR)
+        return json.loads(f.readline())
+
+
+def serveMain(argv):
+    #python pacetools.py serve --socket /tmp/pacetools.sock --workers N --preload paceTemplates/audit_vierge.xml
+
+    import argparse
+    import asyncio
+
+    parser = argparse.ArgumentParser(prog='pacetools.py serve',description='daemon that writes PAE files from json jobs (see serveConnection)')
+    parser.add_argument('--socket',default=None,help='unix socket path (default: localhost, see --port)')
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8765)
+    parser.add_argument('--workers',type=int,default=None,help='number of worker processes (default: one per cpu, 1: in the daemon process)')
+    parser.add_argument('--preload',nargs='*',default=[os.path.join('paceTemplates','audit_vierge.xml')],help='base templates parsed at start')
+    parser.add_argument('--templates-dir',default='paceTemplates',help='sub-templates, materials and library loaded at start')
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(serve(args.socket,args.host,args.port,args.workers,args.preload,args.templates_dir))
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def importTimeMain(argv):
+    #python pacetools.py importtime --budget 50: time of "import pacetools" in a fresh interpreter (python -X importtime),
+    #best of --repeat runs; fails if it is over the budget or if it imports a heavy optional dependency
+
+    import argparse
+    import subprocess
+    import sys
+
+    parser = argparse.ArgumentParser(prog='pacetools.py importtime',description='checks the import time of pacetools')
+    parser.add_argument('--budget',type=float,default=50.,help='in ms (default: 50)')
+    parser.add_argument('--repeat',type=int,default=5)
+    args = parser.parse_args(argv)
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = []
+
+    for k in range(args.repeat):
+
+        result = subprocess.run([sys.executable,'-X','importtime','-c','import pacetools'],cwd=directory,capture_output=True,text=True)
+
+        #import time: self [us] | cumulative | imported package
+        imports = {}
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                fields = line[len('import time:'):].split('|')
+                if fields[1].strip().isdigit():
+                    imports[fields[2].strip()] = int(fields[1])/1000.
+
+        if 'pacetools' not in imports:
+            print('could not import pacetools:',result.stderr.strip().splitlines()[-1:])
+            return 1
+
+        times.append(imports['pacetools'])
+
+    heavy = [name for name in ['numpy'] if name in imports]
+
+    print('import pacetools: %.1f ms (best of %d), budget %.1f ms' % (min(times),args.repeat,args.budget))
+    for name,cumulative in sorted(((name,t) for name,t in imports.items() if name != 'pacetools'),key=lambda x:-x[1])[:5]:
+        print('  %-32s %6.1f ms' % (name,cumulative))
+
+    if len(heavy) > 0:
+        print('imported at import time (should be on first use):',', '.join(heavy))
+
+    return 1 if min(times) > args.budget or len(heavy) > 0 else 0
+
+
 def test1(template,outputname):
 
     #########################
@@ -1518,8 +3523,7 @@ def test1(template,outputname):
     #print("Area ",xml.getFloorPlaneArea('INITIAL'))
 
 
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'))
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.pae'))
+    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'),os.path.join('paceToolsTestDir',outputname+'.pae'))
 
     
     
@@ -1558,8 +3562,7 @@ def test2(template,outputname):
     xml.setInsideTemperature(18)
     xml.setPicture('test_picture.png','init')
     
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'))
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.pae'))
+    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'),os.path.join('paceToolsTestDir',outputname+'.pae'))
 
     
 
@@ -1588,8 +3591,7 @@ def test3(template,outputname):
     xml.addSurfaces(surfacesList)
 
 
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'))
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.pae'))
+    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'),os.path.join('paceToolsTestDir',outputname+'.pae'))
 
     
 
@@ -1635,8 +3637,7 @@ def test4(template,outputname):
     xml.setPicture('test_picture.png','init')
     
     
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'))
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.pae'))
+    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'),os.path.join('paceToolsTestDir',outputname+'.pae'))
 
 
 def test4b(template,outputname):
@@ -1681,8 +3682,7 @@ def test4b(template,outputname):
     xml.setPicture('test_picture.png','init')
     
     
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'))
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.pae'))
+    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'),os.path.join('paceToolsTestDir',outputname+'.pae'))
 
 
 def test4c(template,outputname):
@@ -1745,8 +3745,7 @@ def test4c(template,outputname):
     xml.setVPDescription("C'est le volume protégé")
     xml.setNumberOfFacades(4)    
     
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'))
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.pae'))
+    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'),os.path.join('paceToolsTestDir',outputname+'.pae'))
 
     print("Test 4 c completed")
     
@@ -1800,8 +3799,7 @@ def test5(template,outputname):
 
     xml.setGrossSurface('M1',50)
    
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'))
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.pae'))
+    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'),os.path.join('paceToolsTestDir',outputname+'.pae'))
 
 
 def test6(template,outputname):
@@ -1826,13 +3824,52 @@ def test6(template,outputname):
     
     
     
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'))
-    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.pae'))
+    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.xml'),os.path.join('paceToolsTestDir',outputname+'.pae'))
 
     
 
 
 
+def testUValues(template,outputname):
+
+    #U-value of a wall built with addLayer, against the hand calculation
+    #R = Rsi + Rse + e1/lambda1 + e2/lambda2 = 0.13 + 0.04 + 0.12/0.035 + 0.19/lambda of the blocks
+
+    xml = PACEXML(template)
+    xml.setTemplatesDir('paceTemplates')
+
+    xml.addConstructionElement('wall','M1','mur 1','OPEN_AIR','FULL')
+
+    insulation = {'Category':'Isolants',
+                  'Material':'Laine minérale (MW)',
+                  'Description':'Laine minérale continue',
+                  'lambda':0.035,
+                  'thickness':0.12,
+                  'R':'',
+                  'woodfraction':''}
+
+    blocks = {'Category':'Blocs creux (intérieurs)',
+              'Material':'Blocs creux de béton (19 cm)',
+              'Description':'Bloc 19',
+              'lambda':'',
+              'thickness':0.19,
+              'R':'',
+              'woodfraction':''}
+
+    xml.setWallDetails('M1',0.31,'Pierre < 40',[insulation,blocks])
+
+    #no manual lambda for the blocks and none given: unknown
+    assert np.isnan(xml.getUValues()['uvalue'][0])
+
+    blocksID,groupID = xml.materials.getMaterialAndCategoryID(blocks['Material'],blocks['Category'])
+    uvalues = xml.getUValues(lambdas={blocksID:0.9})
+
+    expected = 1/(0.13+0.04+0.12/0.035+0.19/0.9)
+    assert abs(uvalues['uvalue'][0]-expected) < 1e-9, (uvalues['uvalue'][0],expected)
+
+    xml.writePaceFile(os.path.join('paceToolsTestDir',outputname+'.pae'))
+
+
 def main():
     
     outputTestDir = 'paceToolsTestDir'
@@ -1860,9 +3897,20 @@ def main():
     """    
     
     test6(template,'testWithTemplates')
+
+    testUValues(template,'testUValues')
     
 
 
 if __name__ == "__main__":
     # execute only if run as a script
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        sys.exit(batchMain(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'validate':
+        sys.exit(validateMain(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        sys.exit(serveMain(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'importtime':
+        sys.exit(importTimeMain(sys.argv[2:]))
     main()